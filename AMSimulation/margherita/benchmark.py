@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+from ROOT import gROOT
+from matrixengine import *
+from matrixconfig import *
+import argparse
+import json
+import multiprocessing
+
+# ______________________________________________________________________________
+# Benchmark of the matrix builder on synthetic events (see stubgenerator.py),
+# for regression numbers without the real input. For every size, the events are
+# made and extracted into memory (ingest), then the constants of the default
+# region are trained from them (step1, step2, step2a, step3). Every size runs in
+# a new process, so that the peak memory is that of the size alone.
+#
+# The ingest time is that of making the events, not of reading a ROOT file.
+
+def run_size(args, nentries):
+    options = make_options(fname=synthetic_fname(args.geometry, nentries, args.seed), nentries=-1,
+                           chunk_size=args.chunk_size, workers=args.workers, use_3D=args.use_3D, ntrials=args.ntrials,
+                           cache_dir="", skim=0, make_plots=args.make_plots, missing_layers=0, fixed_point_bits=[],
+                           verbose=0, profile=1, outdir=os.path.join(args.outdir, "n%i" % nentries))
+    if not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+    regions = get_regions(options, args.geometry)
+
+    profiler = Profiler()
+    with profiler.step("ingest"):
+        builder = MatrixBuilder(options)
+        builder.load(regions)
+        profiler.add(events=nentries)
+    builder.run(regions)
+
+    with open(os.path.join(options.outdir, "profile.json")) as f:
+        report = json.load(f)
+    report["steps"] = profiler.steps + report["steps"]
+    report["nentries"] = nentries
+    return report
+
+def run_isolated(func, *args):
+    # Run func in a new process (not a pool worker, which could not start the
+    # workers of the builder) and return its result
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=lambda: queue.put(func(*args)))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+# Times in s, memory in MB
+def summary(reports):
+    lines = ["%-10s %-8s %9s %9s %12s %12s" % ("nentries", "step", "wall", "cpu", "events/s", "peak RSS")]
+    for report in reports:
+        for s in report["steps"]:
+            lines.append("%-10i %-8s %9.3f %9.3f %12.4g %12.1f" % (report["nentries"], s["name"], s["wall"], s["cpu"], s["events_per_s"], s["peak_rss_mb"]))
+        lines.append("%-10i peak RSS of the workers: %.1f" % (report["nentries"], report["peak_rss_children_mb"]))
+    return "\n".join(lines)
+
+def main(args):
+    reports = []
+    for nentries in args.sizes:
+        reports.append(run_isolated(run_size, args, nentries))
+        print summary(reports[-1:])
+
+    path = os.path.join(args.outdir, "benchmark.json")
+    with open(path, "w") as f:
+        json.dump({"geometry": args.geometry, "seed": args.seed, "workers": args.workers, "chunk_size": args.chunk_size, "reports": reports}, f, indent=2, sort_keys=True)
+    print
+    print summary(reports)
+    print "Wrote %s" % path
+    return reports
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the matrix builder on synthetic events")
+    parser.add_argument("--geometry", choices=["barrel", "endcap"], default="barrel", help="geometry of the events and of the region (default: %(default)s)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="numbers of events (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=2016, help="seed of the events (default: %(default)s)")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=default_options["chunk_size"], help="events read at once (default: %(default)s)")
+    parser.add_argument("--use-3D", dest="use_3D", type=int, default=None, help="fit the 4 parameters together (default: 0 in the barrel, 1 in the endcap)")
+    parser.add_argument("--ntrials", type=int, default=default_options["ntrials"], help="number of robust refits in step 2a (default: %(default)s)")
+    parser.add_argument("--make-plots", type=int, default=default_options["make_plots"], help="fill and write the histograms of step 3 (default: %(default)s)")
+    parser.add_argument("--outdir", default="benchmark", help="output directory (default: %(default)s)")
+    args = parser.parse_args()
+    if args.use_3D is None:
+        args.use_3D = int(args.geometry == "endcap")
+
+    gROOT.SetBatch(True)
+
+    main(args)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# root_numpy is the expected dependency to read the trees: it reads the
+# branches in bulk. Without it, read_columns falls back to a loop over the
+# events in PyROOT, which is much slower on the large inputs.
+try:
+    from root_numpy import tree2array
+except ImportError:
+    tree2array = None
+
+warned_fallback = False
+
+# ______________________________________________________________________________
+# Reference
+#   http://scikit-hep.org/root_numpy/reference/generated/root_numpy.tree2array.html
+
+# ______________________________________________________________________________
+# Jagged array: the flattened contents of a vector branch, plus per-event offsets
+#   event i owns content[offsets[i]:offsets[i+1]]
+class JaggedArray:
+    def __init__(self, content, offsets):
+        self.content = content
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def starts(self, mask=None):
+        starts = self.offsets[:-1]
+        if mask is not None:
+            starts = starts[mask]
+        return starts
+
+    def first(self, mask=None):
+        # The selected events must not be empty
+        return self.content[self.starts(mask)]
+
+    def regular(self, n, mask=None):
+        # The selected events must have exactly n entries
+        return self.content[self.starts(mask)[:, np.newaxis] + np.arange(n)]
+
+    def filter(self, keep):
+        # Keep the content entries flagged by 'keep', event boundaries are preserved
+        parents = np.repeat(np.arange(len(self)), self.counts())
+        counts = np.bincount(parents[keep], minlength=len(self))
+        return jagged_from_counts(counts, self.content[keep])
+
+
+def jagged_from_counts(counts, content):
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return JaggedArray(content, offsets)
+
+# ______________________________________________________________________________
+# Readers
+def read_columns(ttree, branches, start, stop):
+    columns = {}
+
+    # Trees that make their columns themselves, e.g. the synthetic events of
+    # stubgenerator.py
+    if hasattr(ttree, "read_columns"):
+        return ttree.read_columns(branches, start, stop)
+
+    if tree2array is not None:
+        arr = tree2array(ttree, branches=branches, start=start, stop=stop)
+        for b in branches:
+            col = arr[b]
+            counts = np.fromiter((len(x) for x in col), dtype=np.int64, count=len(col))
+            if len(col):
+                content = np.concatenate(col)
+            else:
+                content = np.zeros(0)
+            columns[b] = jagged_from_counts(counts, content)
+        return columns
+
+    # Fallback to PyROOT, only the requested branches are read
+    global warned_fallback
+    if not warned_fallback:
+        print "WARNING: root_numpy is not available, reading the tree event by event in PyROOT (slow)"
+        warned_fallback = True
+
+    counts = dict((b, []) for b in branches)
+    contents = dict((b, []) for b in branches)
+
+    ttree.SetBranchStatus("*", 0)
+    for b in branches:
+        ttree.SetBranchStatus(b, 1)
+
+    for ievt in xrange(start, stop):
+        ttree.GetEntry(ievt)
+        for b in branches:
+            v = getattr(ttree, b)
+            counts[b].append(v.size())
+            contents[b].extend(v)
+
+    ttree.SetBranchStatus("*", 1)
+
+    for b in branches:
+        columns[b] = jagged_from_counts(np.asarray(counts[b], dtype=np.int64), np.asarray(contents[b]))
+    return columns
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    counts = np.array([1, 0, 6, 3, 6])
+    content = np.arange(counts.sum(), dtype=np.float64)
+    jagged = jagged_from_counts(counts, content)
+
+    mask = (jagged.counts() == 6)
+    print len(jagged)
+    print jagged.counts()
+    print jagged.regular(6, mask)
+    print jagged.filter(content % 2 == 0).counts()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import json
+import os
+import struct
+import numpy as np
+
+# ______________________________________________________________________________
+# Binary file of the trained constants of one region
+#
+#   magic        8 bytes  "PCACONST"
+#   version      uint32
+#   header_len   uint32
+#   header       json: {"version", "nbits", "metadata", "arrays": [[name, dtype, shape, offset], ...]}
+#   data         raw little-endian arrays, every array aligned to 64 bytes
+#                (offsets are relative to the start of the data)
+#
+# With nbits > 0, every float array x is stored in fixed point as an integer
+# array x_q plus the number of fractional bits x_frac of every row (of every
+# element for 1D arrays), so that x = x_q * 2^-x_frac. The rows are scaled
+# independently to use the full width of a signed nbits integer. The arrays
+# named in per_element have one number of fractional bits per element, e.g. the
+# vectors of every bin of a lookup table stacked into a 2D array.
+
+CONSTANTS_MAGIC = "PCACONST"
+CONSTANTS_VERSION = 1
+CONSTANTS_ALIGN = 64
+
+def _align(n):
+    return (n + CONSTANTS_ALIGN - 1) // CONSTANTS_ALIGN * CONSTANTS_ALIGN
+
+def fixed_point_frac(amax, nbits):
+    # Number of fractional bits such that amax fits in a signed nbits integer
+    amax, nbits = np.broadcast_arrays(np.asarray(amax, dtype=np.float64), np.asarray(nbits, dtype=np.int64))
+    frac = (nbits-1) - np.ceil(np.log2(np.where(amax > 0, amax, 1.0)) + 1e-12).astype(np.int64)
+    frac = np.where(amax > 0, frac, nbits-1)
+    return np.clip(frac, -127, 127)
+
+def round_to_fixed(x, frac, nbits):
+    # Integer values (as floats) of x with frac fractional bits, saturated to nbits
+    qmax = np.power(2.0, np.asarray(nbits) - 1) - 1
+    return np.clip(np.round(x * np.power(2.0, frac)), -qmax, qmax)
+
+def quantize(x, nbits, per_element=False):
+    x = np.asarray(x, dtype=np.float64)
+    per_element = per_element or x.ndim == 1
+    rows = x.reshape(-1, 1) if per_element else x.reshape(-1, x.shape[-1])
+    frac = fixed_point_frac(np.abs(rows).max(axis=1), nbits)
+    q = round_to_fixed(rows, frac[:, np.newaxis], nbits)
+    if nbits <= 16:
+        q = q.astype("<i2")
+    else:
+        q = q.astype("<i4")
+    frac = frac.astype("<i1")
+    if per_element:
+        return q.reshape(x.shape), frac.reshape(x.shape)
+    return q.reshape(x.shape), frac.reshape(x.shape[:-1])
+
+def dequantize(q, frac):
+    q = np.asarray(q, dtype=np.float64)
+    scale = np.power(2.0, -np.asarray(frac, dtype=np.float64))
+    if q.ndim == scale.ndim:
+        return q * scale
+    return q * scale[..., np.newaxis]
+
+# ______________________________________________________________________________
+def save_constants(path, arrays, metadata, nbits=0, per_element=()):
+    if nbits:
+        stored = {}
+        for name, x in arrays.iteritems():
+            stored[name + "_q"], stored[name + "_frac"] = quantize(x, nbits, name in per_element)
+    else:
+        stored = dict((name, np.asarray(x, dtype="<f8")) for name, x in arrays.iteritems())
+
+    entries = []
+    offset = 0
+    for name in sorted(stored):
+        x = np.ascontiguousarray(stored[name])
+        stored[name] = x
+        entries.append([name, x.dtype.str, list(x.shape), offset])
+        offset = _align(offset + x.nbytes)
+
+    header = json.dumps({"version": CONSTANTS_VERSION, "nbits": nbits, "metadata": metadata, "arrays": entries}, sort_keys=True)
+    data_start = _align(16 + len(header))
+
+    # Write to a temporary file first, so that readers never see a partial file
+    tmppath = path + ".tmp%i" % os.getpid()
+    with open(tmppath, "wb") as f:
+        f.write(CONSTANTS_MAGIC)
+        f.write(struct.pack("<II", CONSTANTS_VERSION, len(header)))
+        f.write(header)
+        for name, dtype, shape, offset in entries:
+            f.seek(data_start + offset)
+            f.write(stored[name].tobytes())
+    os.rename(tmppath, path)
+    return path
+
+def read_header(path):
+    with open(path, "rb") as f:
+        magic = f.read(8)
+        if magic != CONSTANTS_MAGIC:
+            raise ValueError("%s is not a constants file" % path)
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version > CONSTANTS_VERSION:
+            raise ValueError("%s has version %i, only up to %i is supported" % (path, version, CONSTANTS_VERSION))
+        header = json.loads(f.read(header_len))
+    return header, _align(16 + header_len)
+
+def load_constants(path, mmap_mode="r", as_float=True):
+    header, data_start = read_header(path)
+
+    # The whole file is mapped once, the arrays are views into it
+    if mmap_mode:
+        buf = np.memmap(path, dtype=np.uint8, mode=mmap_mode)
+    else:
+        buf = np.fromfile(path, dtype=np.uint8)
+
+    arrays = {}
+    for name, dtype, shape, offset in header["arrays"]:
+        dtype = np.dtype(str(dtype))
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        start = data_start + offset
+        arrays[str(name)] = buf[start:start+nbytes].view(dtype).reshape(shape)
+
+    # Fixed-point arrays are converted back to floats unless asked otherwise
+    if header["nbits"] and as_float:
+        names = [name[:-2] for name in arrays if name.endswith("_q")]
+        arrays = dict((name, dequantize(arrays[name + "_q"], arrays[name + "_frac"])) for name in names)
+    return arrays, header["metadata"]
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    import tempfile
+
+    arrays = {
+        "V_var1": np.linalg.qr(np.random.normal(0., 1., (6,6)))[0],
+        "D_var1": np.random.normal(0., 1., (2,6)) * np.asarray([[1e-3], [1.]]),
+        "w_var1": np.asarray([1e-9, 1e-7, 1e-5, 1e-3, 1e-1, 1e1]),
+    }
+    metadata = {"name": "tt27", "geometry": "barrel"}
+
+    tmpdir = tempfile.mkdtemp()
+    for nbits in [0, 18, 12]:
+        path = os.path.join(tmpdir, "constants_q%i.bin" % nbits)
+        save_constants(path, arrays, metadata, nbits=nbits)
+        loaded, loaded_metadata = load_constants(path)
+        print nbits, os.path.getsize(path), loaded_metadata,
+        print max(np.abs(loaded[name] / arrays[name] - 1).max() for name in arrays)
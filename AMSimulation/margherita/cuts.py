@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# ______________________________________________________________________________
+# Window cuts [left, right) on every column of an (N, d) array, and the
+# accounting of the rejections. The values that fail a comparison (e.g. NaN)
+# count as below the window.
+
+def window_masks(x, left, right):
+    # Returns the mask of the rows inside all the windows, and the (N, d)
+    # masks of the values below and above their window
+    with np.errstate(invalid="ignore"):
+        below = ~(left <= x)
+        above = ~(x < right) & ~below
+    inside = ~np.any(below | above, axis=1)
+    return inside, below, above
+
+def column_names(prefix, d):
+    return ["%s[%i]" % (prefix, i) for i in xrange(d)]
+
+# ______________________________________________________________________________
+# Rejection counts of every column
+#   below, above: rows with the value of the column below/above the window
+#   only        : rows rejected by the column and by no other
+class CutFlow:
+    def __init__(self, names):
+        self.names = list(names)
+        d = len(self.names)
+        self.total = 0
+        self.passed = 0
+        self.below = np.zeros(d, dtype=np.int64)
+        self.above = np.zeros(d, dtype=np.int64)
+        self.only = np.zeros(d, dtype=np.int64)
+
+    def fill(self, below, above):
+        rejected = below | above
+        nrejected = rejected.sum(axis=1)
+        self.total += len(rejected)
+        self.passed += int(np.count_nonzero(nrejected == 0))
+        self.below += below.sum(axis=0)
+        self.above += above.sum(axis=0)
+        self.only += rejected[nrejected == 1].sum(axis=0)
+        return
+
+    def merge(self, other):
+        assert(other.names == self.names)
+        self.total += other.total
+        self.passed += other.passed
+        self.below += other.below
+        self.above += other.above
+        self.only += other.only
+        return
+
+    def to_dict(self):
+        return {"total": self.total, "passed": self.passed, "names": self.names,
+                "below": self.below.tolist(), "above": self.above.tolist(), "only": self.only.tolist()}
+
+    def summary(self):
+        lines = ["%-10s %10s %10s %10s %10s" % ("cut", "below", "above", "only", "rejected")]
+        for name, below, above, only in zip(self.names, self.below, self.above, self.only):
+            lines.append("%-10s %10i %10i %10i %9.3f%%" % (name, below, above, only, 100. * (below + above) / max(self.total, 1)))
+        lines.append("passed: %i/%i" % (self.passed, self.total))
+        return "\n".join(lines)
+
+def apply_cuts(x, left, right, cutflow=None):
+    # Mask of the rows of x inside the windows, the rejections are added to
+    # the cut flow
+    inside, below, above = window_masks(x, left, right)
+    if cutflow is not None:
+        cutflow.fill(below, above)
+    return inside
+
+def combine_cutflows(cutflows):
+    cutflows = list(cutflows)
+    assert(len(cutflows) > 0)
+    result = CutFlow(cutflows[0].names)
+    for cutflow in cutflows:
+        result.merge(cutflow)
+    return result
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    x = np.random.normal(0., 1., (100000, 6))
+    x[0, 2] = np.nan
+    left, right = np.percentile(x[1:], 1, axis=0), np.percentile(x[1:], 99, axis=0)
+
+    cutflow = CutFlow(column_names("var1", 6))
+    sel = apply_cuts(x, left, right, cutflow)
+    with np.errstate(invalid="ignore"):
+        print np.array_equal(sel, np.all((left <= x) & (x < right), axis=1))
+    print cutflow.summary()
@@ -2,15 +2,23 @@
 
 import numpy as np
 
+from quantilesketch import QuantileSketch
+from storage import GrowableArray
+
 # ______________________________________________________________________________
 # Reference
 #   https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
 #   http://www.johndcook.com/blog/standard_deviation/
 #   http://www.boost.org/doc/libs/1_61_0/boost/accumulators/statistics/mean.hpp
 
+# ______________________________________________________________________________
+# Quantiles are estimated either from the first cache_size vectors (sketch_k=0),
+# kept in one contiguous array, or from all the vectors with a streaming sketch
+# of accuracy ~1/sketch_k
+
 # ______________________________________________________________________________
 class IncrementalStats:
-    def __init__(self, d=1, cov_d=None, p=0.5, cache_size=1, verbose=0):
+    def __init__(self, d=1, cov_d=None, p=0.5, cache_size=1, verbose=0, sketch_k=0):
         self.d = d
         if cov_d is None:
             cov_d = d
@@ -18,7 +26,12 @@ class IncrementalStats:
         self.p = p
         self.cache_size = cache_size
         self.verbose = verbose
-        self.cache = []
+        self.cache = GrowableArray(d, chunk_rows=max(1, min(cache_size, 65536)))
+        self.sketch_k = sketch_k
+        if sketch_k:
+            self.sketch = QuantileSketch(d=d, k=sketch_k)
+        else:
+            self.sketch = None
         self.cnt = 0
 
         # Sums
@@ -76,12 +89,136 @@ class IncrementalStats:
         # Non-parametric
         self.v_minimum = np.minimum(self.v_minimum, variables)
         self.v_maximum = np.maximum(self.v_maximum, variables)
-        if len(self.cache) < self.cache_size:
+        if self.sketch is not None:
+            self.sketch.add(variables)
+        elif len(self.cache) < self.cache_size:
             self.cache.append(variables)
         else:
             pass
         return
 
+    def add_batch(self, variables, covariables=None, weights=None):
+        assert(variables.ndim == 2 and variables.shape[1] == self.d)
+        if covariables is None:
+            covariables = variables
+        assert(covariables.shape == (len(variables), self.cov_d))
+
+        n = len(variables)
+        if n == 0:
+            return
+
+        # Batch statistics
+        if weights is None:
+            sumw_a = float(self.cnt)
+            sumw_b = float(n)
+            v_mean_b = variables.mean(axis=0)
+            v_mean2_b = covariables.mean(axis=0)
+            v_delta = (variables - v_mean_b)
+            v_delta2 = (covariables - v_mean2_b)
+            v_variance_b = (v_delta * v_delta).sum(axis=0)
+            m_covariance_b = np.dot(v_delta.T, v_delta2)
+        else:
+            assert(weights.shape == (n,))
+            sumw_a = self.sumw
+            sumw_b = float(weights.sum())
+            v_mean_b = np.dot(weights, variables) / sumw_b
+            v_mean2_b = np.dot(weights, covariables) / sumw_b
+            v_delta = (variables - v_mean_b)
+            v_delta2 = (covariables - v_mean2_b)
+            v_variance_b = np.dot(weights, v_delta * v_delta)
+            m_covariance_b = np.dot(v_delta.T * weights, v_delta2)
+
+        self.cnt += n
+
+        # Sums
+        self.sumw += sumw_b
+        self.sumw2 += sumw_b
+
+        # Parametric
+        self._add_moments(sumw_a, sumw_b, v_mean_b, v_mean2_b, v_variance_b, m_covariance_b)
+
+        # Non-parametric
+        self.v_minimum = np.minimum(self.v_minimum, variables.min(axis=0))
+        self.v_maximum = np.maximum(self.v_maximum, variables.max(axis=0))
+        if self.sketch is not None:
+            self.sketch.add_batch(variables)
+        elif len(self.cache) < self.cache_size:
+            self.cache.append(variables[:self.cache_size - len(self.cache)])
+        return
+
+    def merge(self, other):
+        assert(other.d == self.d and other.cov_d == self.cov_d)
+        if (self.sketch is None) != (other.sketch is None):
+            raise ValueError("Cannot merge statistics with and without a quantile sketch (sketch_k=%i and %i)" % (self.sketch_k, other.sketch_k))
+        if other.cnt == 0:
+            return
+
+        sumw_a = self.sumw
+        self.cnt += other.cnt
+
+        # Sums
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+
+        # Parametric
+        self._add_moments(sumw_a, other.sumw, other.v_mean, other.v_mean2, other.v_variance, other.m_covariance)
+
+        # Non-parametric
+        self.v_minimum = np.minimum(self.v_minimum, other.v_minimum)
+        self.v_maximum = np.maximum(self.v_maximum, other.v_maximum)
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+        elif len(self.cache) < self.cache_size:
+            self.cache.append(other.cache.array()[:self.cache_size - len(self.cache)])
+        return
+
+    def _add_moments(self, sumw_a, sumw_b, v_mean_b, v_mean2_b, v_variance_b, m_covariance_b):
+        # Chan et al. pairwise update
+        sumw = sumw_a + sumw_b
+        v_delta = (v_mean_b - self.v_mean)
+        v_delta2 = (v_mean2_b - self.v_mean2)
+        self.v_mean += v_delta * (sumw_b / sumw)
+        self.v_variance += v_variance_b + v_delta * v_delta * (sumw_a * sumw_b / sumw)
+        self.v_mean2 += v_delta2 * (sumw_b / sumw)
+        self.m_covariance += m_covariance_b + np.outer(v_delta, v_delta2) * (sumw_a * sumw_b / sumw)
+        return
+
+    def __getstate__(self):
+        # Store the cache as an array of the filled rows
+        state = self.__dict__.copy()
+        state["cache"] = self.cache.array()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        cache = np.asarray(self.cache).reshape(-1, self.d)
+        self.cache = GrowableArray(self.d, capacity=len(cache), chunk_rows=max(1, min(self.cache_size, 65536)))
+        self.cache.append(cache)
+
+    def select(self, index, cov_index=None):
+        # Statistics of a subset of the variables (and of the covariables, by
+        # default the same subset). The moments of a subset are sub-matrices of
+        # the moments, so the data need not be scanned again.
+        index = np.asarray(index)
+        if cov_index is None:
+            cov_index = index
+        cov_index = np.asarray(cov_index)
+        result = IncrementalStats(d=len(index), cov_d=len(cov_index), p=self.p, cache_size=self.cache_size, verbose=self.verbose, sketch_k=self.sketch_k)
+        result.cnt = self.cnt
+        result.sumw = self.sumw
+        result.sumw2 = self.sumw2
+        result.v_mean = self.v_mean[index]
+        result.v_variance = self.v_variance[index]
+        result.v_mean2 = self.v_mean2[cov_index]
+        result.m_covariance = self.m_covariance[np.ix_(index, cov_index)]
+        result.v_minimum = self.v_minimum[index]
+        result.v_maximum = self.v_maximum[index]
+        if self.sketch is not None:
+            result.sketch = self.sketch.select(index)
+        else:
+            result.cache.append(self.cache.array()[:, index])
+        return result
+
     def dim(self):
         return self.d
 
@@ -91,6 +228,9 @@ class IncrementalStats:
     def mean(self):
         return self.v_mean
 
+    def covariable_mean(self):
+        return self.v_mean2
+
     def variance(self, ddof=0):
         if self.cnt < 2:
             return float('NaN')
@@ -120,7 +260,20 @@ class IncrementalStats:
     def quantile(self, p=None):
         if not p:
             p = self.p
-        return np.percentile(self.cache, p*100, axis=0)
+        if self.sketch is not None:
+            return self.sketch.quantile(p)
+        return np.percentile(self.cache.array(), p*100, axis=0)
+
+# ______________________________________________________________________________
+# Combine partial statistics, e.g. from several processes, in the given order
+def combine(stats):
+    stats = list(stats)
+    assert(len(stats) > 0)
+    s = stats[0]
+    result = IncrementalStats(d=s.d, cov_d=s.cov_d, p=s.p, cache_size=s.cache_size, verbose=s.verbose, sketch_k=s.sketch_k)
+    for s in stats:
+        result.merge(s)
+    return result
 
 
 # ______________________________________________________________________________
@@ -163,3 +316,35 @@ if __name__ == '__main__':
     print np.var(myarray, axis=0)
     print np.average(myarray, axis=0, weights=myarray_w)
     print np.average(np.square(myarray-np.average(myarray, axis=0, weights=myarray_w)), axis=0, weights=myarray_w)
+
+    print "Cross check (batch)"
+    stat_batch = IncrementalStats(d=6, p=0.5, cache_size=nevents/10)
+    for i in xrange(0, nevents, 1000):
+        stat_batch.add_batch(myarray[i:i+1000], weights=myarray_w[i:i+1000])
+    print stat_batch.count()
+    print np.abs(stat_batch.mean() - stat.mean()).max()
+    print np.abs(stat_batch.variance() - stat.variance()).max()
+    print np.abs(stat_batch.covariance() - stat.covariance()).max()
+    print np.abs(stat_batch.quantile() - stat.quantile()).max()
+
+    print "Cross check (merge)"
+    import pickle
+    stat_parts = []
+    for i in xrange(0, nevents, 3000):
+        stat_part = IncrementalStats(d=6, p=0.5, cache_size=nevents/10)
+        stat_part.add_batch(myarray[i:i+3000], weights=myarray_w[i:i+3000])
+        stat_parts.append(pickle.loads(pickle.dumps(stat_part, pickle.HIGHEST_PROTOCOL)))
+    stat_merged = combine(stat_parts)
+    print stat_merged.count()
+    print np.abs(stat_merged.mean() - stat.mean()).max()
+    print np.abs(stat_merged.variance() - stat.variance()).max()
+    print np.abs(stat_merged.covariance() - stat.covariance()).max()
+    print np.abs(stat_merged.quantile() - stat.quantile()).max()
+
+    print "Cross check (sketch)"
+    stat_sketch = IncrementalStats(d=6, p=0.5, sketch_k=200)
+    for variables in myarray:
+        stat_sketch.add(variables)
+    print stat_sketch.count()
+    print stat_sketch.quantile()
+    print np.percentile(myarray, 50, axis=0)
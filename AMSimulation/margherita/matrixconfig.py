@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import argparse
+import copy
+import json
+
+# ______________________________________________________________________________
+# Configuration of the matrix builder. The options are the attributes of an
+# argparse namespace, filled in this order:
+#   1. default_options (updated with the defaults of the builder script)
+#   2. the json config file given with --config, if any
+#   3. the command-line arguments
+
+default_options = {
+    # Input
+    "fname": None,
+    "nentries": 100000,       # number of events, -1 for all
+    "chunk_size": 100000,     # events read at once
+    "workers": 1,             # number of worker processes
+
+    # Regions
+    "use_3D": 0,
+    "towers": None,           # trigger towers to train in one pass instead of the default region
+    "eta_slices": 1,          # split every region into this many eta slices
+    "pre_estimate": 0,        # correct the variables with the pre-estimate from the stubs instead of the true parameters
+    "lut_bins": None,         # (ninvPt, ncotTheta) bins of a lookup table of constants
+
+    # Step 1
+    "cache_size": 10000,
+    "cut_quantiles": (0.01, 0.99),
+    "sketch_k": 0,            # if nonzero, estimate the cuts with a quantile sketch instead of the cached events
+    "cut_tolerance": 0.,      # if nonzero, stop caching when the cuts move by less than this fraction of the cut window
+    "cut_check_size": 1000,   # events cached between the convergence checks of the cuts
+    "smear_seed": 2016,
+    "smear_ps": None,         # smearing half-width of the barrel PS layers [cm], None for the default of the region
+    "smear_2s": None,         # smearing half-width of the barrel 2S layers [cm], None for the default of the region
+    "single_pass": 1,         # if zero, read the input once for the cuts and once more for the data
+    "cache_dir": "",          # if empty, do not cache the training data
+    "skim": 1,                # if nonzero, keep the events passing the selection in cache_dir, and read only those in the next runs
+    "update": False,          # add the events of the input to the statistics of the previous training, without step 2a (ntrials=0)
+    "data_dtype": "float64",  # storage of the training data, float32 halves the memory at the cost of the precision of step 2a
+    "out_of_core": 0,         # if nonzero, write the training data to cache_dir as they are selected and map them from there, for inputs larger than the memory
+
+    # Step 2, 2a
+    "ntrials": 2,             # number of robust refits in step 2a
+    "load_constants": False,  # evaluate the previously exported constants instead of training
+    "missing_layers": 0,      # if nonzero, also export the 5/6 constant sets, one per missing layer
+    "fixed_point_bits": [18], # also export the constants in fixed point with these widths
+
+    # Step 3, output
+    "outdir": ".",
+    "verbose": 1,
+    "make_plots": 1,
+    "precision_study": 0,     # if nonzero, compare the float32 and fixed-point fits with float64 after step 3
+    "profile": 0,             # if nonzero, write the timing of every step to profile.json
+
+    # Parameter scan: [option, value1, value2, ...], every point reuses the
+    # events in memory
+    "scan": None,
+}
+
+def make_options(**kwargs):
+    # Options for scripts and interactive use, without the command line
+    options = copy.deepcopy(default_options)
+    for k in kwargs:
+        if k not in options:
+            raise ValueError("Unknown option: %s" % k)
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    for k in config:
+        if k not in default_options:
+            raise ValueError("Unknown option in %s: %s" % (path, k))
+    return dict((str(k), v) for (k, v) in config.iteritems())
+
+def parse_scan(scan):
+    # e.g. --scan cache_size 5000 10000, the values on the command line are
+    # parsed as json when possible. Returns the option and the list of values.
+    if len(scan) < 2:
+        raise ValueError("A scan needs an option and at least one value: %s" % scan)
+    key, values = str(scan[0]), scan[1:]
+    if key not in default_options:
+        raise ValueError("Unknown option to scan: %s" % key)
+    def parse(v):
+        if not isinstance(v, basestring):
+            return v
+        try:
+            return json.loads(v)
+        except ValueError:
+            return v
+    return key, [parse(v) for v in values]
+
+def make_parser(defaults, description=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--config", help="json file of options, overridden by the command line")
+    parser.add_argument("--fname", help="input file (default: %(default)s)")
+    parser.add_argument("--nentries", type=int, help="number of events, -1 for all (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, help="events read at once (default: %(default)s)")
+    parser.add_argument("-j", "--workers", type=int, help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--use-3D", dest="use_3D", type=int, help="fit the 4 parameters together (default: %(default)s)")
+    parser.add_argument("--towers", type=int, nargs="+", help="train the given trigger towers in one pass instead of the default region")
+    parser.add_argument("--eta-slices", type=int, help="split every region into this many eta slices (default: %(default)s)")
+    parser.add_argument("--pre-estimate", type=int, help="correct the variables with the pre-estimate from the stubs (default: %(default)s)")
+    parser.add_argument("--lut-bins", type=int, nargs=2, metavar=("NINVPT", "NCOTTHETA"), help="train a lookup table of constants binned in the pre-estimated invPt and cotTheta")
+    parser.add_argument("--cache-size", type=int, help="events used for the cuts (default: %(default)s)")
+    parser.add_argument("--cut-quantiles", type=float, nargs=2, help="quantiles of the variable cuts (default: %(default)s)")
+    parser.add_argument("--sketch-k", type=int, help="if nonzero, estimate the cuts with a quantile sketch (default: %(default)s)")
+    parser.add_argument("--cut-tolerance", type=float, help="if nonzero, stop caching when the cuts move by less than this fraction of the cut window (default: %(default)s)")
+    parser.add_argument("--cut-check-size", type=int, help="events cached between the convergence checks of the cuts (default: %(default)s)")
+    parser.add_argument("--smear-seed", type=int, help="seed of the smearing (default: %(default)s)")
+    parser.add_argument("--smear-ps", type=float, help="smearing half-width of the barrel PS layers in cm (default: %(default)s)")
+    parser.add_argument("--smear-2s", dest="smear_2s", type=float, help="smearing half-width of the barrel 2S layers in cm (default: %(default)s)")
+    parser.add_argument("--single-pass", type=int, help="if zero, read the input once for the cuts and once more for the data (default: %(default)s)")
+    parser.add_argument("--cache-dir", help="cache of the training data, empty to disable (default: %(default)s)")
+    parser.add_argument("--skim", type=int, help="if nonzero, keep the events passing the selection in the cache directory (default: %(default)s)")
+    parser.add_argument("--data-dtype", choices=["float64", "float32"], help="storage of the training data (default: %(default)s)")
+    parser.add_argument("--out-of-core", type=int, help="if nonzero, keep the training data on disk in the cache directory instead of in memory (default: %(default)s)")
+    parser.add_argument("--update", action="store_true", help="add the events of the input to the statistics of the previous training (needs --ntrials 0)")
+    parser.add_argument("--ntrials", type=int, help="number of robust refits in step 2a (default: %(default)s)")
+    parser.add_argument("--load-constants", action="store_true", help="evaluate the previously exported constants instead of training")
+    parser.add_argument("--missing-layers", type=int, help="if nonzero, also export the 5/6 constant sets (default: %(default)s)")
+    parser.add_argument("--fixed-point-bits", type=int, nargs="*", help="also export the constants in fixed point with these widths (default: %(default)s)")
+    parser.add_argument("--outdir", help="output directory (default: %(default)s)")
+    parser.add_argument("-v", "--verbose", type=int, help="verbosity (default: %(default)s)")
+    parser.add_argument("--make-plots", type=int, help="fill and write the histograms of step 3 (default: %(default)s)")
+    parser.add_argument("--precision-study", type=int, help="compare the float32 and fixed-point fits with float64 (default: %(default)s)")
+    parser.add_argument("--profile", type=int, help="write the timing of every step to profile.json (default: %(default)s)")
+    parser.add_argument("--scan", nargs="+", metavar=("OPTION", "VALUE"), help="train once for every value of the option, reusing the events in memory")
+    parser.set_defaults(**defaults)
+    return parser
+
+def parse_options(defaults=None, args=None, description=None):
+    options = copy.deepcopy(default_options)
+    if defaults:
+        options.update(defaults)
+    parser = make_parser(options, description)
+
+    # The config file changes the defaults, so that the command line still wins
+    known, unknown = parser.parse_known_args(args)
+    if known.config:
+        options.update(load_config(known.config))
+        parser.set_defaults(**options)
+
+    options = parser.parse_args(args)
+    if options.cut_quantiles is not None:
+        options.cut_quantiles = tuple(options.cut_quantiles)
+    if options.scan:
+        options.scan = parse_scan(options.scan)
+    return options
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    options = parse_options({"fname": "stubs.root"}, ["--nentries", "1000", "--cut-quantiles", "0.05", "0.95", "--scan", "cache_size", "5000", "10000"])
+    print options
+    print make_options(use_3D=1)
@@ -0,0 +1,1540 @@
+#!/usr/bin/env python
+
+from ROOT import TFile, TH1F, TH2F, TF1
+from math import pi
+from itertools import izip
+import numpy as np
+from numpy import linalg as LA
+
+from incrementalstats import *
+from columnar import *
+from parallel import *
+from trainingcache import *
+from constants import *
+from regions import *
+from trackfitter import *
+from profiling import *
+from cuts import *
+from storage import *
+from smearing import *
+from stubgenerator import *
+import copy
+import os
+import pickle
+import shutil
+import time
+
+# ______________________________________________________________________________
+# Matrix builder engine. The constants of several regions are trained in one
+# pass over the input: every chunk of events is read once, and the events are
+# routed to every region whose window they fall in.
+#
+# The options are the attributes of an argparse namespace (or anything alike),
+# see matrixconfig.py for the list and the defaults.
+
+# Bumped whenever the content of the cached training sets changes
+TRAINING_SET_VERSION = 4
+
+nparameters2D = 2
+nvariables2D = 6
+nparameters3D = nparameters2D*2
+nvariables3D = nvariables2D*2
+
+gen_branches = ["genParts_pt", "genParts_phi", "genParts_eta", "genParts_vz", "genParts_charge"]
+stub_branches = ["TTStubs_phi", "TTStubs_z", "TTStubs_r"]
+
+myptbins = [0.0, 0.5, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 10.0, 12.0, 15.0, 20.0, 25.0, 30.0, 35.0, 40.0, 45.0, 50.0, 55.0, 60.0, 70.0, 80.0, 100.0, 125.0, 150.0, 200.0, 250.0, 300.0, 350.0, 400.0, 500.0, 600.0, 800.0, 1000.0, 2000.0, 7000.0]
+
+# The tree of the input, every process keeps its own one open. It is reopened
+# when another input is asked for, e.g. in a scan over fname.
+tfile = None
+ttree = None
+tree_fname = None
+
+
+# ______________________________________________________________________________
+def open_tree(fname):
+    global tfile
+    global ttree
+    global tree_fname
+    if ttree is not None and tree_fname == fname:
+        return ttree
+    if tfile is not None:
+        tfile.Close()
+    tree_fname = fname
+
+    # The synthetic events are made on the fly, see stubgenerator.py
+    tfile = None
+    ttree = open_synthetic(fname)
+    if ttree is None:
+        tfile = TFile.Open(fname)
+        ttree = tfile.Get("ntupler/tree")
+    return ttree
+
+def get_branches(regions):
+    branches = gen_branches + stub_branches
+    if any(region.layers is not None for region in regions):
+        branches = branches + ["TTStubs_modId"]
+    return branches
+
+def region_layers(region):
+    return None if region.layers is None else tuple(region.layers)
+
+def get_layer_sets(regions):
+    # The distinct sets of stub layers, in the order of the regions
+    layer_sets = []
+    for region in regions:
+        layers = region_layers(region)
+        if layers not in layer_sets:
+            layer_sets.append(layers)
+    return layer_sets
+
+def count_entries(options):
+    ntotal = open_tree(options.fname).GetEntries()
+    if options.nentries >= 0:
+        ntotal = min(ntotal, options.nentries)
+    return ntotal
+
+# ______________________________________________________________________________
+# Events with 1 particle and 6 stubs in the given layers, start is the entry
+# number of the first event of the columns
+def extract_events(columns, layers=None, start=0):
+    genParts_pt = columns["genParts_pt"]
+    TTStubs_phi = columns["TTStubs_phi"]
+    TTStubs_r = columns["TTStubs_r"]
+    TTStubs_z = columns["TTStubs_z"]
+
+    # Collect the desired TTStubs
+    if layers is not None:
+        keep = np.in1d(columns["TTStubs_modId"].content // 10000, layers)
+        TTStubs_phi = TTStubs_phi.filter(keep)
+        TTStubs_r = TTStubs_r.filter(keep)
+        TTStubs_z = TTStubs_z.filter(keep)
+
+    # Must have 1 particle
+    # Must have 6 stubs
+    sel = (genParts_pt.counts() == 1) & (TTStubs_phi.counts() == 6)
+
+    # The events are kept in the types of the ntuple, and converted to float64
+    # by region_candidates
+    events = {}
+    events["entry"] = start + np.flatnonzero(sel)
+    events["simCharge"] = columns["genParts_charge"].first(sel)
+    events["simPt"] = genParts_pt.first(sel)
+    events["simPhi"] = columns["genParts_phi"].first(sel)
+    events["simEta"] = columns["genParts_eta"].first(sel)
+    events["simVz"] = columns["genParts_vz"].first(sel)
+    events["TTStubs_phi"] = TTStubs_phi.regular(6, sel)
+    events["TTStubs_r"] = TTStubs_r.regular(6, sel)
+    events["TTStubs_z"] = TTStubs_z.regular(6, sel)
+    return events
+
+# ______________________________________________________________________________
+# Variables and parameters of the events in the region
+def region_candidates(events, region, smear_seed):
+    simInvPt = events["simCharge"].astype(np.float64) / events["simPt"]
+    simPhi = events["simPhi"].astype(np.float64)
+    simEta = events["simEta"].astype(np.float64)
+    simVz = events["simVz"].astype(np.float64)
+
+    # Must satisfy invPt, eta and phi ranges
+    window = (region.minInvPt <= simInvPt) & (simInvPt < region.maxInvPt) & (region.minEta <= simEta) & (simEta < region.maxEta)
+    if region.minPhi is not None:
+        window &= ((simPhi - region.minPhi) % (2*pi)) < (region.maxPhi - region.minPhi)
+
+    entry, simInvPt, simPhi, simEta, simVz = events["entry"][window], simInvPt[window], simPhi[window], simEta[window], simVz[window]
+    simCotTheta = np.sinh(simEta)
+    TTStubs_phi, TTStubs_r, TTStubs_z = [events[b][window].astype(np.float64) for b in ["TTStubs_phi", "TTStubs_r", "TTStubs_z"]]
+
+    # Apply smearing of the coarse coordinate (z in the barrel, r in the endcap),
+    # drawn for every event from (smear_seed, entry number)
+    smear = None
+    if region.smear_z is not None:
+        smear = smear_stubs(smear_seed, entry, region.smear_z)
+
+    # Correct with the pre-estimate from the (smeared) stubs, as in the fitter
+    invPt, cotTheta = simInvPt, simCotTheta
+    if region.pre_estimate:
+        if smear is None:
+            invPt, cotTheta = pre_estimate(TTStubs_phi, TTStubs_r, TTStubs_z)
+        elif region.geometry == "barrel":
+            invPt, cotTheta = pre_estimate(TTStubs_phi, TTStubs_r, TTStubs_z + smear)
+        else:
+            invPt, cotTheta = pre_estimate(TTStubs_phi, TTStubs_r + smear, TTStubs_z)
+
+        # Must satisfy pre-estimate ranges
+        sel = np.ones(len(invPt), dtype=bool)
+        if region.minPreInvPt is not None:
+            sel &= (region.minPreInvPt <= invPt) & (invPt < region.maxPreInvPt)
+        if region.minPreCotTheta is not None:
+            sel &= (region.minPreCotTheta <= cotTheta) & (cotTheta < region.maxPreCotTheta)
+        simInvPt, simPhi, simCotTheta, simVz, invPt, cotTheta = simInvPt[sel], simPhi[sel], simCotTheta[sel], simVz[sel], invPt[sel], cotTheta[sel]
+        TTStubs_phi, TTStubs_r, TTStubs_z = TTStubs_phi[sel], TTStubs_r[sel], TTStubs_z[sel]
+        if smear is not None:
+            smear = smear[sel]
+
+    parameters1 = np.column_stack((simInvPt, simPhi))
+    parameters2 = np.column_stack((simCotTheta, simVz))
+
+    variables1, variables2 = make_variables(region, TTStubs_phi, TTStubs_r, TTStubs_z, invPt, cotTheta, smear)
+    return variables1, variables2, parameters1, parameters2
+
+# ______________________________________________________________________________
+# Route a chunk of events to every region. The events are extracted once for
+# each distinct set of stub layers.
+def extract_chunk(columns, layer_sets, start):
+    return dict((layers, extract_events(columns, layers, start)) for layers in layer_sets)
+
+def ingest_events(extracted, regions, smear_seed):
+    return [region_candidates(extracted[region_layers(region)], region, smear_seed) for region in regions]
+
+# ______________________________________________________________________________
+# Skims: the events that pass the selection of extract_events (1 particle, 6
+# stubs in the layers) are kept in the cache directory, one skim per input and
+# set of layers. The next runs read the skims instead of the tree. The skims
+# store the entry numbers of the events, so that the smearing and the results
+# are the same as when reading the tree.
+SKIM_VERSION = 2
+
+def skim_key(fname, ntotal, layers):
+    return cache_key("skim", SKIM_VERSION, input_signature(fname), ntotal, layers)
+
+def slice_events(events, start, stop):
+    # The events of the entries [start, stop), read into memory
+    i, j = np.searchsorted(events["entry"], [start, stop])
+    return dict((k, np.array(v[i:j])) for (k, v) in events.iteritems())
+
+def extract_shard(shard):
+    start, stop, fname, branches, layer_sets = shard
+    return start, stop, extract_chunk(read_columns(open_tree(fname), branches, start, stop), layer_sets, start)
+
+def make_skims(options, layer_sets, ntotal):
+    # Returns the cache keys of the skims of every set of layers, the missing
+    # skims are made in one pass over the tree
+    keys = dict((layers, skim_key(options.fname, ntotal, layers)) for layers in layer_sets)
+    missing = [layers for layers in layer_sets if not os.path.isdir(os.path.join(options.cache_dir, keys[layers]))]
+    if not missing:
+        return keys
+
+    if options.verbose > 0:
+        print "Skimming %s into %s" % (options.fname, options.cache_dir)
+    branches = gen_branches + stub_branches + ["TTStubs_modId"]
+    shards = split_entries(ntotal, options.chunk_size)
+
+    # The events of every shard are appended to the skims as they arrive (in
+    # the order of the entries), in the types of the ntuple
+    tmppaths = dict((layers, begin_training_set(options.cache_dir, keys[layers])) for layers in missing)
+    skims = dict((layers, {}) for layers in missing)
+    for (start, stop, extracted) in map_shards(extract_shard, [(start, stop, options.fname, branches, missing) for (start, stop) in shards], options.workers):
+        for layers in missing:
+            for (k, v) in extracted[layers].iteritems():
+                if k not in skims[layers]:
+                    skims[layers][k] = DiskArray(os.path.join(tmppaths[layers], k + ".npy"), v.shape[1] if v.ndim == 2 else None, dtype=v.dtype)
+                skims[layers][k].append(v)
+    for layers in missing:
+        count = len(skims[layers]["entry"])
+        for storage in skims[layers].itervalues():
+            storage.close()
+        commit_training_set(options.cache_dir, keys[layers], tmppaths[layers], {"fname": options.fname, "ntotal": ntotal, "layers": layers, "count": count})
+        if options.verbose > 0:
+            print "Skim of layers %s: %i/%i events" % (layers, count, ntotal)
+    return keys
+
+def use_skims(options):
+    return bool(options.skim and options.cache_dir)
+
+def select_candidates(candidates, cuts, region):
+    if region.use_3D:
+        nvariables = nvariables3D
+        nparameters = nparameters3D
+    else:
+        nvariables = nvariables2D
+        nparameters = nparameters2D
+
+    variables1, variables2, parameters1, parameters2 = candidates
+
+    # Must satisfy variable ranges
+    left_cuts_var1, right_cuts_var1, left_cuts_var2, right_cuts_var2 = [np.broadcast_to(c, (nvariables2D,)) for c in cuts]
+    cutflow = CutFlow(cut_names(region))
+    if region.cut_var2:
+        sel = apply_cuts(np.hstack((variables1, variables2)), np.concatenate((left_cuts_var1, left_cuts_var2)), np.concatenate((right_cuts_var1, right_cuts_var2)), cutflow)
+    else:
+        sel = apply_cuts(variables1, left_cuts_var1, right_cuts_var1, cutflow)
+    variables1, variables2, parameters1, parameters2 = variables1[sel], variables2[sel], parameters1[sel], parameters2[sel]
+
+    # Concatenate
+    if region.use_3D:
+        variables1 = np.hstack((variables1, variables2))
+        variables2 = variables1
+        parameters1 = np.hstack((parameters1, parameters2))
+        parameters2 = parameters1
+
+    stat_var1 = IncrementalStats(d=nvariables)
+    stat_var2 = IncrementalStats(d=nvariables)
+    stat_par1 = IncrementalStats(d=nparameters)
+    stat_par2 = IncrementalStats(d=nparameters)
+    stat_var1.add_batch(variables1)
+    stat_var2.add_batch(variables2)
+    stat_par1.add_batch(parameters1)
+    stat_par2.add_batch(parameters2)
+
+    # For D1 & D2
+    stat_vp1 = IncrementalStats(d=nvariables, cov_d=nparameters)
+    stat_vp2 = IncrementalStats(d=nvariables, cov_d=nparameters)
+    stat_vp1.add_batch(variables1, covariables=parameters1)
+    stat_vp2.add_batch(variables2, covariables=parameters2)
+    return (stat_var1, stat_var2, stat_par1, stat_par2, stat_vp1, stat_vp2), (variables1, variables2, parameters1, parameters2), cutflow
+
+def cut_names(region):
+    names = column_names("var1", nvariables2D)
+    if region.cut_var2:
+        names += column_names("var2", nvariables2D)
+    return names
+
+def bytes_read():
+    if tfile is None:
+        return 0
+    return tfile.GetBytesRead()
+
+# Returns the candidates (or the selected data, with the cuts) of every region,
+# and the timing of the shard
+def process_shard_step1(shard):
+    start, stop, regions, options, cuts = shard
+    t0, bytes0 = time.time(), bytes_read()
+    columns = read_columns(open_tree(options.fname), get_branches(regions), start, stop)
+    t1 = time.time()
+    extracted = extract_chunk(columns, get_layer_sets(regions), start)
+    candidates, profile = process_events_step1(extracted, start, stop, regions, options, cuts)
+    profile["io"] = t1 - t0
+    profile["numpy"] = time.time() - t1
+    profile["bytes_read"] = bytes_read() - bytes0
+    return candidates, profile
+
+# The same from the skims, given their cache keys
+def process_skim_step1(shard):
+    start, stop, regions, options, cuts, keys = shard
+    t0 = time.time()
+    extracted = {}
+    for layers in get_layer_sets(regions):
+        extracted[layers] = slice_events(load_training_set(options.cache_dir, keys[layers])[0], start, stop)
+    t1 = time.time()
+    candidates, profile = process_events_step1(extracted, start, stop, regions, options, cuts)
+    profile["io"] = t1 - t0
+    profile["bytes_read"] = sum(v.nbytes for events in extracted.itervalues() for v in events.itervalues())
+    return candidates, profile
+
+def process_events_step1(extracted, start, stop, regions, options, cuts):
+    t0 = time.time()
+    candidates = ingest_events(extracted, regions, options.smear_seed)
+    if cuts is not None:
+        candidates = [select_candidates(c, cut, region) for (c, cut, region) in izip(candidates, cuts, regions)]
+    profile = {"io": 0., "bytes_read": 0, "events": stop - start, "numpy": time.time() - t0}
+    return candidates, profile
+
+def fill_histogram(h, x, y=None):
+    # Bulk fill with unit weights
+    n = len(x)
+    if n == 0:
+        return
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    w = np.ones(n)
+    if y is None:
+        h.FillN(n, x, w)
+    else:
+        h.FillN(n, x, np.ascontiguousarray(y, dtype=np.float64), w)
+    return
+
+def region_path(path, region, nregions, outdir=""):
+    # One output file per region when there are several of them
+    if nregions > 1:
+        root, ext = os.path.splitext(path)
+        path = "%s_%s%s" % (root, region.name, ext)
+    if outdir:
+        path = os.path.join(outdir, path)
+    return path
+
+def print_stats(stat, quantiles=()):
+    print "count: ", stat.count()
+    print "mean : ", stat.mean()
+    print "var  : ", stat.variance()
+    print "cov  : ", stat.covariance()
+    for p in quantiles:
+        print "q%02i  : " % int(round(p*100)), stat.quantile(p=p)
+    print
+    return
+
+
+# ______________________________________________________________________________
+# Eigenvalues and eigenvectors (as rows) of the covariance of the variables
+def principal_components(stat_var):
+    w, v = LA.eigh(stat_var.covariance())
+    return w, v.transpose()
+
+# Least squares D of the parameters vs the principal components V, from the
+# statistics of the variables: cov(pc) = V cov(var) V^T, cov(pc, par) = V cov(var, par)
+def solve_pc(stat_var, stat_vp, V):
+    cov_pc = np.dot(np.dot(V, stat_var.covariance()), V.T)
+    cov_D = np.dot(V, stat_vp.covariance())
+
+    # Solve for least squares D
+    #q_pc, r_pc = LA.qr(cov_pc)
+    #d_pc = np.dot(LA.inv(r_pc), np.dot(q_pc.transpose(), cov_pc))
+    #d_pc = LA.solve(cov_pc, cov_D)
+    soln_pc = LA.lstsq(cov_pc, cov_D)
+    D_pc = soln_pc[0].transpose()
+    return D_pc, cov_pc, cov_D
+
+# D is solved from the covariances, i.e. for the centred variables and
+# parameters. The fit is D var + b, with the offsets b = mean(par) - D mean(var).
+def solve_offsets(stat_vp, D):
+    return stat_vp.covariable_mean() - np.dot(D, stat_vp.mean())
+
+# Indices of the variables without the given layer
+def missing_layer_index(missing_layer, use_3D=0):
+    index = [i for i in xrange(nvariables2D) if i != missing_layer]
+    if use_3D:
+        index += [nvariables2D + i for i in index]
+    return index
+
+
+# ______________________________________________________________________________
+# Steps 2a and 3 go over the training data in blocks of chunk_size, in a pool of
+# worker processes if workers > 1. The inputs of the pass are set in
+# block_inputs before the pool is forked, so that the workers share the data
+# (also when they are memory-mapped) instead of receiving copies. The partial
+# results are combined in block order by the caller, so that they do not depend
+# on the number of workers.
+block_inputs = None
+
+def map_blocks(func, inputs, blocks, workers):
+    global block_inputs
+    block_inputs = inputs
+    try:
+        for result in map_shards(func, blocks, workers):
+            yield result
+    finally:
+        block_inputs = None
+
+def trim_block(block):
+    trainer, good_events, cuts, do_trim = block_inputs
+    start, stop = block
+    return trainer.trim_block(start, stop, good_events[start:stop].copy(), cuts, do_trim)
+
+def evaluate_stats_block(block):
+    trainer = block_inputs
+    start, stop = block
+    return trainer.evaluate_stats(start)
+
+def merge_stats(stats, partial):
+    for (s, p) in izip(stats, partial):
+        s.merge(p)
+    return
+
+def first_selected(sel, n, block_size):
+    # Indices of the first n selected events, the scan stops once they are found
+    ievts = []
+    count = 0
+    for start in xrange(0, len(sel), block_size):
+        if count >= n:
+            break
+        i = start + np.flatnonzero(sel[start:start+block_size])[:n-count]
+        ievts.append(i)
+        count += len(i)
+    return np.concatenate(ievts) if ievts else np.zeros(0, dtype=np.int64)
+
+
+# ______________________________________________________________________________
+# The data and the constants of one region
+class RegionTrainer:
+    def __init__(self, region, options, profiler=None):
+        self.region = region
+        self.options = options
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        self.profiler = profiler
+        if region.use_3D:
+            self.nvariables = nvariables3D
+            self.nparameters = nparameters3D
+        else:
+            self.nvariables = nvariables2D
+            self.nparameters = nparameters2D
+
+        # Data
+        self.stat_var1 = None
+        self.stat_var2 = None
+        self.stat_par1 = None
+        self.stat_par2 = None
+        self.stat_vp1 = None
+        self.stat_vp2 = None
+        self.data_var1 = None
+        self.data_var2 = None
+        self.data_par1 = None
+        self.data_par2 = None
+
+        # Results
+        self.w_var1 = None
+        self.w_var2 = None
+        self.V_var1 = None
+        self.V_var2 = None
+        self.D_var1 = None
+        self.D_var2 = None
+        self.b_var1 = None
+        self.b_var2 = None
+        self.mean_pc1 = None
+        self.mean_pc2 = None
+
+        # Step 1 bookkeeping: the statistics and the cut flow of every shard,
+        # the selected data are copied into growable arrays as they come
+        self.cuts = None
+        self.cutflow = None
+        self.buffered = []
+        self.results = []
+        self.storage = None
+        self.spill_dir = None
+
+        # Convergence of the cuts while caching: the (count, change) at every
+        # check, the quantiles at the last check and the stable checks in a row
+        self.convergence = []
+        self.last_quantiles = None
+        self.stable = 0
+
+        # Incremental training: the cuts and the statistics of the previous
+        # inputs, and the list of (fname, nentries) already included
+        self.fixed_cuts = None
+        self.previous = None
+        self.inputs = []
+
+    # __________________________________________________________________________
+    # Step 1
+    def training_cache_key(self):
+        options = self.options
+        return cache_key(TRAINING_SET_VERSION, input_signature(options.fname), options.nentries, options.cache_size, options.cut_quantiles, options.sketch_k, options.cut_tolerance, options.cut_check_size, options.smear_seed, options.data_dtype, self.region.key())
+
+    def load_training_set(self):
+        options = self.options
+        if not options.cache_dir or self.previous is not None:
+            return False
+        with self.profiler.timer("io"):
+            cached = load_training_set(options.cache_dir, self.training_cache_key())
+        if cached is None:
+            return False
+
+        arrays, (self.cuts, stats, self.cutflow) = cached
+        self.stat_var1, self.stat_var2, self.stat_par1, self.stat_par2, self.stat_vp1, self.stat_vp2 = stats
+        self.inputs = [(options.fname, options.nentries)]
+        self.data_var1 = arrays["data_var1"]
+        self.data_par1 = arrays["data_par1"]
+        if self.region.use_3D:
+            self.data_var2 = self.data_var1
+            self.data_par2 = self.data_par1
+        else:
+            self.data_var2 = arrays["data_var2"]
+            self.data_par2 = arrays["data_par2"]
+        if options.verbose > 0:
+            print "Loaded training data of %s from cache: %s" % (self.region.name, self.training_cache_key())
+            print "count: ", self.stat_var1.count()
+            print
+        return True
+
+    def begin_step1(self):
+        options = self.options
+        self.stat_var1 = IncrementalStats(d=nvariables2D, cache_size=options.cache_size, sketch_k=options.sketch_k)
+        self.stat_var2 = IncrementalStats(d=nvariables2D, cache_size=options.cache_size, sketch_k=options.sketch_k)
+        self.cuts = self.fixed_cuts
+        self.buffered = []
+        self.results = []
+        if self.region.use_3D:
+            names, dims = ["data_var1", "data_par1"], [self.nvariables, self.nparameters]
+        else:
+            names, dims = ["data_var1", "data_var2", "data_par1", "data_par2"], [self.nvariables, self.nvariables, self.nparameters, self.nparameters]
+        if options.out_of_core:
+            # The data are written directly to a new entry of the training cache
+            self.spill_dir = begin_training_set(options.cache_dir, self.training_cache_key())
+            self.storage = [DiskArray(os.path.join(self.spill_dir, name + ".npy"), d, dtype=options.data_dtype) for (name, d) in izip(names, dims)]
+        else:
+            self.storage = [GrowableArray(d, dtype=options.data_dtype) for d in dims]
+        self.convergence = []
+        self.last_quantiles = None
+        self.stable = 0
+        return
+
+    def cache_full(self):
+        return self.stat_var1.count() == self.options.cache_size or self.stable >= 2
+
+    def next_check(self):
+        # Number of cached events at the next convergence check
+        options = self.options
+        if not options.cut_tolerance:
+            return options.cache_size
+        return min(options.cache_size, (self.stat_var1.count() // options.cut_check_size + 1) * options.cut_check_size)
+
+    def check_convergence(self):
+        # Change of the cut quantiles since the last check, relative to the
+        # width of the cut window of every variable. The cuts are converged when
+        # the change is below cut_tolerance at two checks in a row.
+        options = self.options
+        stats = [self.stat_var1, self.stat_var2] if self.region.cut_var2 else [self.stat_var1]
+        left = np.concatenate([stat.quantile(p=options.cut_quantiles[0]) for stat in stats])
+        right = np.concatenate([stat.quantile(p=options.cut_quantiles[1]) for stat in stats])
+        quantiles = np.concatenate((left, right))
+        if self.last_quantiles is not None:
+            width = np.tile(np.maximum(right - left, 1e-12), 2)
+            change = np.max(np.abs(quantiles - self.last_quantiles) / width)
+            self.convergence.append((self.stat_var1.count(), change))
+            if change < options.cut_tolerance:
+                self.stable += 1
+            else:
+                self.stable = 0
+        self.last_quantiles = quantiles
+        return
+
+    def add_candidates(self, candidates):
+        if self.cuts is not None:
+            self.add_result(select_candidates(candidates, self.cuts, self.region))
+            return
+
+        # Cache the first cache_size events, or fewer if the cuts converge
+        # before (with cut_tolerance). In single-pass mode, the candidates are
+        # also buffered until the cuts are known
+        variables1, variables2 = candidates[0], candidates[1]
+        i = 0
+        while i < len(variables1) and not self.cache_full():
+            target = self.next_check()
+            n = min(len(variables1) - i, target - self.stat_var1.count())
+            self.stat_var1.add_batch(variables1[i:i+n])
+            self.stat_var2.add_batch(variables2[i:i+n])
+            i += n
+            if self.options.cut_tolerance and self.stat_var1.count() == target:
+                self.check_convergence()
+        if self.options.single_pass:
+            self.buffered.append(candidates)
+            if self.cache_full():
+                self.set_cuts()
+        return
+
+    def set_cuts(self):
+        options = self.options
+        stat_var1, stat_var2 = self.stat_var1, self.stat_var2
+
+        if stat_var1.count() == 0:
+            # No event in the region
+            self.cuts = (-np.inf, np.inf, -np.inf, np.inf)
+        else:
+            if options.verbose > 0:
+                print "region: ", self.region.name
+                print_stats(stat_var1, (0.01, 0.05, 0.50, 0.95, 0.99))
+                print_stats(stat_var2, (0.01, 0.05, 0.50, 0.95, 0.99))
+                if options.cut_tolerance:
+                    print "cut convergence (count, change): "
+                    for count, change in self.convergence:
+                        print "  %8i %12.4g" % (count, change)
+                    print
+
+            if options.cut_tolerance and self.stable < 2 and stat_var1.count() == options.cache_size:
+                print "Cuts of %s not converged to %g after %i events, increase cache_size" % (self.region.name, options.cut_tolerance, options.cache_size)
+
+            #left_cuts_var1, right_cuts_var1 = stat_var1.quantile(p=0.05), stat_var1.quantile(p=0.95)
+            #left_cuts_var2, right_cuts_var2 = stat_var2.quantile(p=0.05), stat_var2.quantile(p=0.95)
+            left_cuts_var1, right_cuts_var1 = stat_var1.quantile(p=options.cut_quantiles[0]), stat_var1.quantile(p=options.cut_quantiles[1])
+            left_cuts_var2, right_cuts_var2 = stat_var2.quantile(p=options.cut_quantiles[0]), stat_var2.quantile(p=options.cut_quantiles[1])
+            self.cuts = (left_cuts_var1, right_cuts_var1, left_cuts_var2, right_cuts_var2)
+
+        for candidates in self.buffered:
+            self.add_result(select_candidates(candidates, self.cuts, self.region))
+        self.buffered = []
+        return
+
+    def add_result(self, result):
+        stats, data, cutflow = result
+        self.results.append((stats, cutflow))
+        if self.region.use_3D:
+            data = (data[0], data[2])
+        for (storage, x) in izip(self.storage, data):
+            storage.append(x)
+        return
+
+    def end_step1(self):
+        options = self.options
+
+        # The input ended before the cache was full
+        if self.cuts is None:
+            self.set_cuts()
+
+        stats = [x[0] for x in self.results]
+        self.cutflow = combine_cutflows([CutFlow(cut_names(self.region))] + [x[1] for x in self.results])
+        self.results = []
+
+        # The statistics of the previous inputs are updated with the new events
+        if self.previous is not None:
+            stats.insert(0, self.previous)
+        self.inputs = self.inputs + [(options.fname, options.nentries)]
+
+        with self.profiler.timer("numpy"):
+            self.stat_var1 = combine(s[0] for s in stats)
+            self.stat_var2 = combine(s[1] for s in stats)
+            self.stat_par1 = combine(s[2] for s in stats)
+            self.stat_par2 = combine(s[3] for s in stats)
+            self.stat_vp1 = combine(s[4] for s in stats)
+            self.stat_vp2 = combine(s[5] for s in stats)
+
+            # The contiguous (N, d) arrays, or their files mapped into memory
+            if options.out_of_core:
+                data = [storage.array() for storage in self.storage]
+            else:
+                data = [storage.trim() for storage in self.storage]
+            self.storage = None
+            if self.region.use_3D:
+                self.data_var1, self.data_par1 = data
+                self.data_var2 = self.data_var1
+                self.data_par2 = self.data_par1
+            else:
+                self.data_var1, self.data_var2, self.data_par1, self.data_par2 = data
+
+        if options.out_of_core:
+            # The mapped files stay valid after the directory is renamed or removed
+            with self.profiler.timer("io"):
+                if self.previous is None:
+                    commit_training_set(options.cache_dir, self.training_cache_key(), self.spill_dir, (self.cuts, self.statistics(), self.cutflow))
+                else:
+                    shutil.rmtree(self.spill_dir)
+            self.spill_dir = None
+        elif options.cache_dir and self.previous is None:
+            arrays = {"data_var1": self.data_var1, "data_par1": self.data_par1}
+            if not self.region.use_3D:
+                arrays["data_var2"] = self.data_var2
+                arrays["data_par2"] = self.data_par2
+            with self.profiler.timer("io"):
+                save_training_set(options.cache_dir, self.training_cache_key(), arrays, (self.cuts, self.statistics(), self.cutflow))
+
+        if options.verbose > 0:
+            print "region: ", self.region.name
+            print self.cutflow.summary()
+            print
+            print_stats(self.stat_var1)
+            print_stats(self.stat_var2)
+            print_stats(self.stat_par1)
+            print_stats(self.stat_par2)
+        return
+
+    # __________________________________________________________________________
+    # Sufficient statistics. The constants only depend on the mean and the
+    # covariance of the variables, and on their cross-covariance with the
+    # parameters, so that the training can be updated with new events without
+    # rereading the previous ones.
+    def statistics(self):
+        return (self.stat_var1, self.stat_var2, self.stat_par1, self.stat_par2, self.stat_vp1, self.stat_vp2)
+
+    def save_statistics(self, path):
+        state = {"region": self.region.to_dict(), "cuts": self.cuts, "inputs": self.inputs, "stats": self.statistics()}
+        tmppath = path + ".tmp%i" % os.getpid()
+        with open(tmppath, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+        if self.options.verbose > 0:
+            print "Wrote statistics of %s to %s" % (self.region.name, path)
+        return
+
+    def load_statistics(self, path):
+        options = self.options
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state["region"] != self.region.to_dict():
+            raise ValueError("%s contains the statistics of %s, not %s" % (path, state["region"]["name"], self.region.name))
+        if (options.fname, options.nentries) in state["inputs"]:
+            raise ValueError("%s already includes %s (nentries=%i)" % (path, options.fname, options.nentries))
+
+        # The new events are selected with the same cuts as the previous ones
+        self.fixed_cuts = state["cuts"]
+        self.previous = state["stats"]
+        self.inputs = state["inputs"]
+        if options.verbose > 0:
+            print "Loaded statistics of %s from %s" % (self.region.name, path)
+            print "inputs: ", self.inputs
+            print "count : ", self.previous[0].count()
+            print
+        return
+
+    # __________________________________________________________________________
+    # Step 2
+    def solve(self, stat_vp1, stat_vp2):
+        D_pc1, cov_pc1, cov_D1 = solve_pc(self.stat_var1, stat_vp1, self.V_var1)
+        D_pc2, cov_pc2, cov_D2 = solve_pc(self.stat_var2, stat_vp2, self.V_var2)
+        self.D_var1 = np.dot(D_pc1, self.V_var1)
+        self.D_var2 = np.dot(D_pc2, self.V_var2)
+        self.b_var1 = solve_offsets(stat_vp1, self.D_var1)
+        self.b_var2 = solve_offsets(stat_vp2, self.D_var2)
+        self.mean_pc1 = np.dot(self.V_var1, self.stat_var1.mean())
+        self.mean_pc2 = np.dot(self.V_var2, self.stat_var2.mean())
+
+        if self.options.verbose > 0:
+            print "mean : ", self.mean_pc1
+            print "cov  : ", cov_pc1
+            print "mean : ", self.mean_pc2
+            print "cov  : ", cov_pc2
+            print
+            print "count: ", stat_vp1.count()
+            print "cov  : ", cov_D1
+            print "D    : ", D_pc1
+            print "DV   : ", self.D_var1
+            print "b    : ", self.b_var1
+            print
+            print "count: ", stat_vp2.count()
+            print "cov  : ", cov_D2
+            print "D    : ", D_pc2
+            print "DV   : ", self.D_var2
+            print "b    : ", self.b_var2
+            print
+        return
+
+    def find_eigenvectors(self):
+        self.w_var1, self.V_var1 = principal_components(self.stat_var1)
+        self.w_var2, self.V_var2 = principal_components(self.stat_var2)
+        return self.V_var1.transpose(), self.V_var2.transpose()
+
+    def process_step2(self):
+        # Find eigenvectors
+        v_var1, v_var2 = self.find_eigenvectors()
+
+        if self.options.verbose > 0:
+            print "# Step 2: %s" % self.region.name
+            print "w: ", self.w_var1
+            print "v: ", v_var1
+            print
+            print "w: ", self.w_var2
+            print "v: ", v_var2
+            print
+
+        # ______________________________________________________________________
+        # Find solutions
+        self.solve(self.stat_vp1, self.stat_vp2)
+        return
+
+    # __________________________________________________________________________
+    # Step 2a
+    def error_weights(self, parameters_err):
+        # Per-event weights from the (N, nparameters) fit errors, None for unit weights
+        return None
+
+    def trim_block(self, start, stop, good, cuts, do_trim=True):
+        # Statistics of the events of [start, stop) passing the cuts on the fit
+        # errors, the good mask of the block is updated
+        nvariables, nparameters = self.nvariables, self.nparameters
+        D_var1, D_var2, b_var1, b_var2 = self.D_var1, self.D_var2, self.b_var1, self.b_var2
+        left_cuts_err, right_cuts_err = cuts
+
+        stat_var1 = IncrementalStats(d=nvariables)
+        stat_var2 = IncrementalStats(d=nvariables)
+        stat_par1 = IncrementalStats(d=nparameters)
+        stat_par2 = IncrementalStats(d=nparameters)
+        stat_vp1 = IncrementalStats(d=nvariables, cov_d=nparameters)
+        stat_vp2 = IncrementalStats(d=nvariables, cov_d=nparameters)
+        cutflow = CutFlow(column_names("err1", nparameters) + column_names("err2", nparameters))
+
+        variables1, variables2 = float64_block(self.data_var1[start:stop]), float64_block(self.data_var2[start:stop])
+        parameters1, parameters2 = float64_block(self.data_par1[start:stop]), float64_block(self.data_par2[start:stop])
+
+        # Fit parameters
+        parameters_err1 = np.dot(variables1, D_var1.T) + b_var1 - parameters1
+        parameters_err2 = np.dot(variables2, D_var2.T) + b_var2 - parameters2
+        w_err1 = self.error_weights(parameters_err1)
+        w_err2 = self.error_weights(parameters_err2)
+
+        # Simple trimming
+        if do_trim:
+            good &= apply_cuts(np.hstack((parameters_err1, parameters_err2)), left_cuts_err, right_cuts_err, cutflow)
+
+        # Skip events
+        variables1, variables2, parameters1, parameters2 = variables1[good], variables2[good], parameters1[good], parameters2[good]
+        if w_err1 is not None:
+            w_err1 = w_err1[good]
+        if w_err2 is not None:
+            w_err2 = w_err2[good]
+
+        stat_var1.add_batch(variables1, weights=w_err1)
+        stat_var2.add_batch(variables2, weights=w_err2)
+        stat_par1.add_batch(parameters1, weights=w_err1)
+        stat_par2.add_batch(parameters2, weights=w_err2)
+
+        # For D1 & D2
+        stat_vp1.add_batch(variables1, covariables=parameters1, weights=w_err1)
+        stat_vp2.add_batch(variables2, covariables=parameters2, weights=w_err2)
+        return (stat_var1, stat_var2, stat_par1, stat_par2, stat_vp1, stat_vp2), good, cutflow
+
+    def process_step2a(self, ntrials=2, do_trim=True):
+        options = self.options
+        nvariables, nparameters = self.nvariables, self.nparameters
+        cache_size, chunk_size = options.cache_size, options.chunk_size
+        data_var1, data_var2, data_par1, data_par2 = self.data_var1, self.data_var2, self.data_par1, self.data_par2
+        blocks = split_entries(len(data_var1), chunk_size)
+
+        good_events = np.ones(len(data_var1), dtype=bool)
+
+        for itrial in xrange(ntrials):
+            D_var1, D_var2, b_var1, b_var2 = self.D_var1, self.D_var2, self.b_var1, self.b_var2
+
+            if options.verbose > 0:
+                print "# Step 2a: %s" % self.region.name
+                print "itrial: %i" % itrial
+
+            stat_err1 = IncrementalStats(d=nparameters, cache_size=cache_size)
+            stat_err2 = IncrementalStats(d=nparameters, cache_size=cache_size)
+
+            # Fit parameters of the first good events
+            ievts = first_selected(good_events, cache_size, chunk_size)
+            parameters_err1 = np.dot(float64_block(data_var1[ievts]), D_var1.T) + b_var1 - data_par1[ievts]
+            parameters_err2 = np.dot(float64_block(data_var2[ievts]), D_var2.T) + b_var2 - data_par2[ievts]
+
+            stat_err1.add_batch(parameters_err1)
+            stat_err2.add_batch(parameters_err2)
+
+            q25_err1 = stat_err1.quantile(p=0.25)
+            q25_err2 = stat_err2.quantile(p=0.25)
+            q75_err1 = stat_err1.quantile(p=0.75)
+            q75_err2 = stat_err2.quantile(p=0.75)
+            iqr_err1 = (q75_err1 - q25_err1)
+            iqr_err2 = (q75_err2 - q25_err2)
+            left_cuts_err1 = q25_err1 - iqr_err1 * 4
+            left_cuts_err2 = q25_err2 - iqr_err2 * 4
+            right_cuts_err1 = q75_err1 + iqr_err1 * 4
+            right_cuts_err2 = q75_err2 + iqr_err2 * 4
+
+            if options.verbose > 0:
+                for (stat_err, left_cuts_err, right_cuts_err) in [(stat_err1, left_cuts_err1, right_cuts_err1), (stat_err2, left_cuts_err2, right_cuts_err2)]:
+                    print "count : ", stat_err.count()
+                    print "mean  : ", stat_err.mean()
+                    print "std   : ", stat_err.stdev()
+                    print "min   : ", stat_err.minimum()
+                    print "max   : ", stat_err.maximum()
+                    print "lcuts : ", left_cuts_err
+                    print "rcuts : ", right_cuts_err
+                    print
+
+            stats = (IncrementalStats(d=nvariables), IncrementalStats(d=nvariables),
+                     IncrementalStats(d=nparameters), IncrementalStats(d=nparameters),
+                     IncrementalStats(d=nvariables, cov_d=nparameters), IncrementalStats(d=nvariables, cov_d=nparameters))
+            cutflow = CutFlow(column_names("err1", nparameters) + column_names("err2", nparameters))
+
+            cuts = (np.concatenate((left_cuts_err1, left_cuts_err2)), np.concatenate((right_cuts_err1, right_cuts_err2)))
+            for ((start, stop), (partial, good, partial_cutflow)) in izip(blocks, map_blocks(trim_block, (self, good_events, cuts, do_trim), blocks, options.workers)):
+                good_events[start:stop] = good
+                merge_stats(stats, partial)
+                cutflow.merge(partial_cutflow)
+
+            stat_var1, stat_var2, stat_par1, stat_par2, stat_vp1, stat_vp2 = stats
+            self.stat_var1, self.stat_var2, self.stat_par1, self.stat_par2 = stat_var1, stat_var2, stat_par1, stat_par2
+            self.stat_vp1, self.stat_vp2 = stat_vp1, stat_vp2
+            if options.verbose > 0 and do_trim:
+                print cutflow.summary()
+                print
+
+            # Find eigenvectors
+            self.find_eigenvectors()
+
+            self.solve(stat_vp1, stat_vp2)
+            continue
+        return
+
+    # __________________________________________________________________________
+    # Constants
+    def get_constants(self):
+        names = ["V_var1", "V_var2", "D_var1", "D_var2", "b_var1", "b_var2", "w_var1", "w_var2", "mean_pc1", "mean_pc2"]
+        constants = dict((name, getattr(self, name)) for name in names)
+
+        # Ranges of the variables, for the fixed-point LSBs
+        constants["absmax_var1"] = np.maximum(np.abs(self.stat_var1.minimum()), np.abs(self.stat_var1.maximum()))
+        constants["absmax_var2"] = np.maximum(np.abs(self.stat_var2.minimum()), np.abs(self.stat_var2.maximum()))
+        return constants
+
+    def get_missing_layer_constants(self, missing_layer):
+        # The constants of the 5 other layers are solved from the sub-matrices
+        # of the 6-layer statistics, i.e. from the same events without the
+        # stubs of the missing layer
+        index = missing_layer_index(missing_layer, self.region.use_3D)
+        constants = {}
+        for i, stat_var, stat_vp in [(1, self.stat_var1, self.stat_vp1), (2, self.stat_var2, self.stat_vp2)]:
+            stat_var = stat_var.select(index)
+            stat_vp = stat_vp.select(index, np.arange(self.nparameters))
+            w, V = principal_components(stat_var)
+            D_pc = solve_pc(stat_var, stat_vp, V)[0]
+            D = np.dot(D_pc, V)
+            constants["w_var%i" % i] = w
+            constants["V_var%i" % i] = V
+            constants["D_var%i" % i] = D
+            constants["b_var%i" % i] = solve_offsets(stat_vp, D)
+            constants["mean_pc%i" % i] = np.dot(V, stat_var.mean())
+            constants["absmax_var%i" % i] = np.maximum(np.abs(stat_var.minimum()), np.abs(stat_var.maximum()))
+        return constants
+
+    def save_constants(self, path, nbits=0, missing_layer=None):
+        if missing_layer is None:
+            constants = self.get_constants()
+        else:
+            constants = self.get_missing_layer_constants(missing_layer)
+        if nbits:
+            constants = rounded_offsets(constants, nbits, nbits)
+        metadata = {"region": self.region.to_dict(), "count": self.stat_var1.count(), "missing_layer": missing_layer}
+        save_constants(path, constants, metadata, nbits=nbits)
+        if self.options.verbose > 0:
+            print "Wrote constants of %s to %s" % (self.region.name, path)
+        return
+
+    def load_constants(self, path):
+        arrays, metadata = load_constants(path)
+        if metadata["region"]["name"] != self.region.name:
+            raise ValueError("%s contains the constants of %s, not %s" % (path, metadata["region"]["name"], self.region.name))
+        for name, x in arrays.iteritems():
+            setattr(self, name, x)
+        return
+
+    def process_missing_layers(self):
+        # Resolution of the 5/6 constant sets on the training events with the
+        # stubs of one layer dropped, relative to the 6/6 set
+        chunk_size = self.options.chunk_size
+        nevents = len(self.data_par1)
+        data_var1, data_var2 = self.data_var1, self.data_var2
+        if self.region.use_3D:
+            data_var1, data_var2 = data_var1[:, :nvariables2D], data_var1[:, nvariables2D:]
+
+        def parameters_block(i):
+            if self.region.use_3D:
+                return float64_block(self.data_par1[i:i+chunk_size])
+            return np.hstack((float64_block(self.data_par1[i:i+chunk_size]), float64_block(self.data_par2[i:i+chunk_size])))
+
+        print "# Missing layers: %s" % self.region.name
+        print "%-10s %s" % ("missing", "resolution (relative to 6/6) [bias] of invPt, phi, cotTheta, z0")
+        for missing_layer in [None] + range(nvariables2D):
+            if missing_layer is None:
+                fitter = TrackFitter(self.region, self.get_constants())
+                index = range(nvariables2D)
+            else:
+                fitter = TrackFitter(self.region, self.get_missing_layer_constants(missing_layer), missing_layer=missing_layer)
+                index = missing_layer_index(missing_layer)
+            stat_err = IncrementalStats(d=nparameters3D)
+            for i in xrange(0, nevents, chunk_size):
+                fitted = fitter.fit_variables(data_var1[i:i+chunk_size, index], data_var2[i:i+chunk_size, index])[0]
+                stat_err.add_batch(fitted - parameters_block(i))
+            bias, resolution = stat_err.mean(), stat_err.stdev()
+            if missing_layer is None:
+                reference = resolution
+            print "%-10s %s" % ("none" if missing_layer is None else "layer %i" % missing_layer, "  ".join("%.3e (%.4f) [%+.1e]" % x for x in izip(resolution, resolution / reference, bias)))
+        print
+        return
+
+    def process_precision_study(self, fixed_point_bits=(18,)):
+        parameters = [self.data_par1] if self.region.use_3D else [self.data_par1, self.data_par2]
+        data_var1, data_var2 = self.data_var1, self.data_var2
+        if self.region.use_3D:
+            # The fitter takes the two sets of variables separately
+            data_var1, data_var2 = data_var1[:, :nvariables2D], data_var1[:, nvariables2D:]
+
+        results = precision_study(self.region, self.get_constants(), data_var1, data_var2, parameters, default_precision_modes(fixed_point_bits), self.options.chunk_size)
+
+        print "# Precision study: %s" % self.region.name
+        print "%-10s %10s  %s" % ("mode", "fits/s", "resolution (relative to %s) [bias] of invPt, phi, cotTheta, z0" % results[0][0])
+        for name, rate, bias, resolution, relative in results:
+            print "%-10s %10.3g  %s" % (name, rate, "  ".join("%.3e (%.4f) [%+.1e]" % x for x in izip(resolution, relative, bias)))
+        print
+        return results
+
+    # __________________________________________________________________________
+    # Step 3
+    def evaluate_block(self, ievt):
+        chunk_size = self.options.chunk_size
+        variables1, variables2 = float64_block(self.data_var1[ievt:ievt+chunk_size]), float64_block(self.data_var2[ievt:ievt+chunk_size])
+        parameters1, parameters2 = float64_block(self.data_par1[ievt:ievt+chunk_size]), float64_block(self.data_par2[ievt:ievt+chunk_size])
+
+        # Principal components
+        principals1 = np.dot(variables1, self.V_var1.T)
+        principals2 = np.dot(variables2, self.V_var2.T)
+
+        # Fit parameters
+        parameters_fit1 = np.dot(variables1, self.D_var1.T) + self.b_var1
+        parameters_fit2 = np.dot(variables2, self.D_var2.T) + self.b_var2
+        parameters_err1 = parameters_fit1 - parameters1
+        parameters_err2 = parameters_fit2 - parameters2
+
+        errPt = (1.0/np.abs(parameters_fit1[:,0]) - 1.0/np.abs(parameters1[:,0])) * np.abs(parameters1[:,0])
+        errInvPt = (parameters1[:,0] - parameters_fit1[:,0]) / np.abs(parameters1[:,0])
+        parameters_errPt = np.column_stack((errPt, errInvPt))
+        return principals1, principals2, parameters_err1, parameters_err2, parameters_errPt, parameters1, parameters2
+
+    def evaluate_stats(self, ievt):
+        # Statistics of the principal components and of the fit errors of a block
+        cache_size = self.options.cache_size
+        principals1, principals2, parameters_err1, parameters_err2 = self.evaluate_block(ievt)[:4]
+        stats = (IncrementalStats(d=self.nvariables, cache_size=cache_size), IncrementalStats(d=self.nvariables, cache_size=cache_size),
+                 IncrementalStats(d=self.nparameters, cache_size=cache_size), IncrementalStats(d=self.nparameters, cache_size=cache_size))
+        for (stat, x) in izip(stats, [principals1, principals2, parameters_err1, parameters_err2]):
+            stat.add_batch(x)
+        return stats
+
+    def book_histograms(self):
+        region = self.region
+        histos = {}
+
+        def par_binning(j):
+            if j < len(region.par_bins):
+                return (par_titles[j],) + tuple(region.par_bins[j])
+            return ("", 20, -1., 1.)
+
+        for i in xrange(nvariables3D):
+            hname = "npc%i" % (i)
+            htitle = "principal component %i" % (i)
+            nbinsx, xmin, xmax = 1000, -7., 7.
+            histos[hname] = TH1F(hname, ";"+htitle, nbinsx, xmin, xmax)
+
+            htitle2, nbinsy, ymin, ymax = htitle, nbinsx, xmin, xmax
+            for j in xrange(nparameters3D):
+                hname = "npc%i_vs_par%i" % (i,j)
+                htitle, nbinsx, xmin, xmax = par_binning(j)
+                histos[hname] = TH2F(hname, ";"+htitle+";"+htitle2, nbinsx, xmin, xmax, nbinsy, ymin, ymax)
+
+        for i in xrange(nparameters3D + 2):
+            hname = "err%i" % (i)
+            if i < len(region.err_bins):
+                htitle = err_titles[i]
+                nbinsx, xmin, xmax = region.err_bins[i]
+            else:
+                htitle = ""
+                nbinsx, xmin, xmax = 1000, -1., 1.
+            histos[hname] = TH1F(hname, ";"+htitle, nbinsx, xmin, xmax)
+
+            htitle2, nbinsy, ymin, ymax = htitle, nbinsx, xmin, xmax
+            for j in xrange(nparameters3D):
+                hname = "err%i_vs_par%i" % (i,j)
+                htitle, nbinsx, xmin, xmax = par_binning(j)
+                histos[hname] = TH2F(hname, ";"+htitle+";"+htitle2, nbinsx, xmin, xmax, nbinsy, ymin, ymax)
+
+            hname = "err%i_vs_pt" % (i)
+            htitle = "p_{T} [GeV]"
+            histos[hname] = TH2F(hname, ";"+htitle+";"+htitle2, len(myptbins)-1, np.array(myptbins), nbinsy, ymin, ymax)
+            hname = "err%i_vs_eta" % (i)
+            htitle = "|#eta|"
+            nbinsx, xmin, xmax = 25, 0, 2.5
+            histos[hname] = TH2F(hname, ";"+htitle+";"+htitle2, nbinsx, xmin, xmax, nbinsy, ymin, ymax)
+        return histos
+
+    def process_step3(self, outfile="histos.root"):
+        options = self.options
+        use_3D = self.region.use_3D
+        nvariables, nparameters = self.nvariables, self.nparameters
+        cache_size, chunk_size = options.cache_size, options.chunk_size
+
+        if options.verbose > 0:
+            print "# Step 3: %s" % self.region.name
+
+        # ______________________________________________________________________
+        # Evaluate fit errors
+
+        # The events are evaluated in blocks of chunk_size, once for the
+        # statistics (by the workers) and once more for the histograms
+        stats = (IncrementalStats(d=nvariables, cache_size=cache_size), IncrementalStats(d=nvariables, cache_size=cache_size),
+                 IncrementalStats(d=nparameters, cache_size=cache_size), IncrementalStats(d=nparameters, cache_size=cache_size))
+
+        with self.profiler.timer("numpy"):
+            for partial in map_blocks(evaluate_stats_block, self, split_entries(len(self.data_var1), chunk_size), options.workers):
+                merge_stats(stats, partial)
+        stat_pc1, stat_pc2, stat_err1, stat_err2 = stats
+
+        if options.verbose > 0:
+            for stat in [stat_pc1, stat_pc2, stat_err1, stat_err2]:
+                print_stats(stat, (0.05, 0.50, 0.95))
+
+        # ______________________________________________________________________
+        # Make plots
+        if not options.make_plots:
+            return
+
+        histos = self.book_histograms()
+
+        # Fill histograms
+        assert(len(self.data_par2) == len(self.data_par1))
+        assert(len(self.data_var1) == len(self.data_par1))
+
+        # Normalization of the principal components
+        scale1 = np.zeros(len(self.w_var1))
+        scale2 = np.zeros(len(self.w_var2))
+        scale1[np.abs(self.w_var1) > 1e-14] = 1.0/np.sqrt(self.w_var1[np.abs(self.w_var1) > 1e-14])
+        scale2[np.abs(self.w_var2) > 1e-14] = 1.0/np.sqrt(self.w_var2[np.abs(self.w_var2) > 1e-14])
+
+        for ievt in xrange(0, len(self.data_var1), chunk_size):
+            with self.profiler.timer("numpy"):
+                principals1, principals2, parameters_err1, parameters_err2, parameters_errPt, parameters1, parameters2 = self.evaluate_block(ievt)
+
+                # Concatenate
+                if not use_3D:
+                    x1 = (principals1 - stat_pc1.mean()) * scale1
+                    x2 = (principals2 - stat_pc2.mean()) * scale2
+                    x_npc = np.hstack((x1,x2))
+                    p = np.hstack((parameters1,parameters2))
+                else:
+                    x1 = (principals1 - stat_pc1.mean()) * scale1
+                    x_npc = x1
+                    p = parameters1
+
+                # Concatenate
+                if not use_3D:
+                    x_err = np.hstack((parameters_err1,parameters_err2,parameters_errPt))
+                else:
+                    x_err = np.hstack((parameters_err1,parameters_errPt))
+
+                pt = 1.0/np.abs(p[:,0])
+                theta = np.arctan2(1.0, p[:,2])
+                eta = -np.log(np.tan(theta/2.0))
+                eta = np.abs(eta)
+
+            with self.profiler.timer("hist"):
+                x = x_npc
+                for i in xrange(nvariables3D):
+                    hname = "npc%i" % (i)
+                    fill_histogram(histos[hname], x[:,i])
+
+                    for j in xrange(nparameters3D):
+                        hname = "npc%i_vs_par%i" % (i,j)
+                        fill_histogram(histos[hname], p[:,j], x[:,i])
+
+                x = x_err
+                for i in xrange(nparameters3D + 2):
+                    hname = "err%i" % (i)
+                    fill_histogram(histos[hname], x[:,i])
+
+                    for j in xrange(nparameters3D):
+                        hname = "err%i_vs_par%i" % (i,j)
+                        fill_histogram(histos[hname], p[:,j], x[:,i])
+
+                    hname = "err%i_vs_pt" % (i)
+                    fill_histogram(histos[hname], pt, x[:,i])
+                    hname = "err%i_vs_eta" % (i)
+                    fill_histogram(histos[hname], eta, x[:,i])
+
+        # Write histograms
+        with self.profiler.timer("io"):
+            tfile = TFile.Open(outfile, "RECREATE")
+            for hname, h in sorted(histos.iteritems()):
+                h.Write()
+            tfile.Close()
+
+        # Print statistics
+        printme = []
+        for hname, h in sorted(histos.iteritems()):
+            if h.ClassName() == "TH1F":
+                h.Draw("hist")
+                if h.Integral() > 0:
+                    h.Fit("gaus","q")
+                    h.fit = h.GetFunction("gaus")
+                else:
+                    h.fit = TF1("fa1", "gaus(0)")
+                s = "%s, %f, %f, %f, %f" % (hname, h.GetMean(), h.GetRMS(), h.fit.GetParameter(1), h.fit.GetParameter(2))
+                printme.append(s)
+        print '\n'.join(printme)
+        return
+
+
+# ______________________________________________________________________________
+# 1st step of all the regions in one pass over the input
+def run_step1(trainers, options, profiler=None, events=None):
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+
+    if options.verbose > 0:
+        print "# Step 1"
+        print "fname     : ", options.fname
+        print "nentries  : ", options.nentries
+        print "workers   : ", options.workers
+        for trainer in trainers:
+            region = trainer.region
+            print "region    : ", region
+            print "use_3D    : ", region.use_3D
+            if region.geometry == "barrel":
+                print "r_center  : ", region.r_center
+            else:
+                print "z_center  : ", region.z_center
+            print "phi_center: ", region.phi_center
+            print "eta_center: ", region.eta_center
+        print
+
+    trainers = [trainer for trainer in trainers if not trainer.load_training_set()]
+    if not trainers:
+        return
+
+    # The events are either read by the workers from the tree or from the
+    # skims, or already in memory (the (start, stop, extracted events) of
+    # every shard)
+    if events is None:
+        ntotal = count_entries(options)
+        shards = split_entries(ntotal, options.chunk_size)
+        keys = None
+        if use_skims(options):
+            keys = make_skims(options, get_layer_sets([trainer.region for trainer in trainers]), ntotal)
+
+    def map_step1(regions, cuts):
+        if events is not None:
+            return (process_events_step1(extracted, start, stop, regions, options, cuts) for (start, stop, extracted) in events)
+        if keys is not None:
+            return map_shards(process_skim_step1, [(start, stop, regions, options, cuts, keys) for (start, stop) in shards], options.workers)
+        return map_shards(process_shard_step1, [(start, stop, regions, options, cuts) for (start, stop) in shards], options.workers)
+
+    regions = [trainer.region for trainer in trainers]
+
+    for trainer in trainers:
+        trainer.begin_step1()
+
+    # In single-pass mode, every region selects its data from the same pass as
+    # soon as its cuts are known. Otherwise, the regions without cuts (from a
+    # previous training) need a first pass to find them.
+    if options.single_pass:
+        pending = trainers
+    else:
+        pending = [trainer for trainer in trainers if trainer.cuts is None]
+
+    if pending:
+        candidates = map_step1([trainer.region for trainer in pending], None)
+
+        for candidates_shard, shard_profile in candidates:
+            profiler.add(**shard_profile)
+            with profiler.timer("numpy"):
+                for (trainer, c) in izip(pending, candidates_shard):
+                    trainer.add_candidates(c)
+
+            if not options.single_pass and all(trainer.cache_full() for trainer in pending):
+                break
+
+    if not options.single_pass:
+        if pending:
+            candidates.close()
+        for trainer in trainers:
+            if trainer.cuts is None:
+                trainer.set_cuts()
+        cuts = [trainer.cuts for trainer in trainers]
+        for results_shard, shard_profile in map_step1(regions, cuts):
+            profiler.add(**shard_profile)
+            for (trainer, r) in izip(trainers, results_shard):
+                trainer.add_result(r)
+
+    for trainer in trainers:
+        trainer.end_step1()
+    return
+
+# ______________________________________________________________________________
+# All the steps of all the regions
+def train(regions, options, events=None):
+    if options.out_of_core and not options.cache_dir:
+        raise ValueError("The training data are kept out of core in the cache directory, cache_dir must be set")
+    if options.update and options.ntrials > 0 and not options.load_constants:
+        # The robust refit of step 2a needs the residuals of every event, the
+        # previous events are not stored
+        raise ValueError("Step 2a cannot be run when updating a previous training, ntrials must be 0")
+    if options.outdir and not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+    profiler = Profiler(enabled=options.profile)
+    trainers = [RegionTrainer(region, options, profiler) for region in regions]
+
+    # Add the events of the input to the statistics of a previous training
+    if options.update:
+        for trainer in trainers:
+            trainer.load_statistics(region_path("statistics.pkl", trainer.region, len(trainers), options.outdir))
+
+    # 1st step: loop over events to get rough estimates of all the statistics,
+    #   reject outliers, accumulate data
+    with profiler.step("step1"):
+        run_step1(trainers, options, profiler, events)
+
+    for trainer in trainers:
+        name = trainer.region.name
+        if len(trainer.data_var1) < 2:
+            print "Region %s has no events, skipped" % name
+            continue
+
+        # 2nd step: compute the coefficients
+        path = region_path("constants.bin", trainer.region, len(trainers), options.outdir)
+        if options.load_constants:
+            with profiler.step("load", name), profiler.timer("io"):
+                trainer.load_constants(path)
+        else:
+            with profiler.step("step2", name):
+                with profiler.timer("numpy"):
+                    trainer.process_step2()
+                with profiler.timer("io"):
+                    trainer.save_statistics(region_path("statistics.pkl", trainer.region, len(trainers), options.outdir))
+                profiler.add(events=len(trainer.data_var1))
+
+            with profiler.step("step2a", name):
+                with profiler.timer("numpy"):
+                    trainer.process_step2a(ntrials=options.ntrials)
+                profiler.add(events=len(trainer.data_var1) * options.ntrials)
+
+            with profiler.step("export", name), profiler.timer("io"):
+                trainer.save_constants(path)
+                for nbits in options.fixed_point_bits:
+                    trainer.save_constants(region_path("constants_q%i.bin" % nbits, trainer.region, len(trainers), options.outdir), nbits=nbits)
+
+                # The 5/6 constant sets, one per missing layer
+                if options.missing_layers:
+                    for missing_layer in xrange(nvariables2D):
+                        trainer.save_constants(region_path("constants_miss%i.bin" % missing_layer, trainer.region, len(trainers), options.outdir), missing_layer=missing_layer)
+                        for nbits in options.fixed_point_bits:
+                            trainer.save_constants(region_path("constants_miss%i_q%i.bin" % (missing_layer, nbits), trainer.region, len(trainers), options.outdir), nbits=nbits, missing_layer=missing_layer)
+
+        # 3rd step: evaluate with the coefficients
+        with profiler.step("step3", name):
+            trainer.process_step3(region_path("histos.root", trainer.region, len(trainers), options.outdir))
+            profiler.add(events=len(trainer.data_var1))
+        if options.precision_study:
+            trainer.process_precision_study(options.fixed_point_bits)
+        if options.missing_layers and options.verbose > 0:
+            trainer.process_missing_layers()
+
+    # Timing report
+    if options.profile:
+        convergence = dict((trainer.region.name, trainer.convergence) for trainer in trainers if trainer.convergence)
+        profiler.write(os.path.join(options.outdir, "profile.json"), fname=options.fname, nentries=options.nentries, workers=options.workers, chunk_size=options.chunk_size, regions=[region.name for region in regions], cut_convergence=convergence,
+                       cutflows=dict((trainer.region.name, trainer.cutflow.to_dict()) for trainer in trainers if trainer.cutflow is not None))
+        if options.verbose > 0:
+            print "# Profile"
+            print profiler.summary()
+            print
+    return trainers
+
+# ______________________________________________________________________________
+# Lookup tables of constants binned in the pre-estimated (invPt, cotTheta), all
+# the bins of all the regions are trained in one pass
+def train_lut(regions, nbins, options, events=None):
+    grid = [lut_regions(region, *nbins) for region in regions]
+    trainers = train([r for bins in grid for r in bins], options, events)
+
+    nbins_total = nbins[0] * nbins[1]
+    for iregion, region in enumerate(regions):
+        bins = trainers[iregion*nbins_total:(iregion+1)*nbins_total]
+        trained = [k for (k, trainer) in enumerate(bins) if trainer.D_var1 is not None]
+        if not trained:
+            print "Region %s has no events, no lookup table" % region.name
+            continue
+
+        # The empty bins use the constants of the closest trained bin
+        constants = []
+        for k in xrange(nbins_total):
+            closest = min(trained, key=lambda x: (x/nbins[1] - k/nbins[1])**2 + (x%nbins[1] - k%nbins[1])**2)
+            if closest != k:
+                print "Bin %s has no events, use the constants of %s" % (bins[k].region.name, bins[closest].region.name)
+            constants.append(bins[closest].get_constants())
+
+        invPt_edges, cotTheta_edges = lut_edges(region, *nbins)
+        metadata = {"region": region.copy(pre_estimate=1).to_dict(), "count": [trainer.stat_var1.count() for trainer in bins]}
+        path = region_path("constants_lut.bin", region, len(regions), options.outdir)
+        save_lut(path, invPt_edges, cotTheta_edges, constants, metadata)
+        for nbits in options.fixed_point_bits:
+            save_lut(region_path("constants_lut_q%i.bin" % nbits, region, len(regions), options.outdir), invPt_edges, cotTheta_edges, constants, metadata, nbits=nbits)
+        if options.verbose > 0:
+            print "Wrote lookup table of %s to %s" % (region.name, path)
+    return trainers
+
+
+# ______________________________________________________________________________
+# The matrix builder of one configuration. The selected events can be read
+# once into memory and reused by several configurations, e.g. in a parameter
+# scan, as long as they share the input (fname, nentries and chunk_size).
+class MatrixBuilder:
+    def __init__(self, options):
+        self.options = options
+        self.events = None
+        self.events_key = None
+        self.layer_sets = None
+
+    def input_key(self, options):
+        return (options.fname, options.nentries, options.chunk_size)
+
+    def in_memory(self, regions, options):
+        return self.events is not None and self.events_key == self.input_key(options) and set(get_layer_sets(regions)) <= set(self.layer_sets)
+
+    def load(self, regions, options=None):
+        if options is None:
+            options = self.options
+        if self.in_memory(regions, options):
+            return self.events
+
+        if options.verbose > 0:
+            print "Reading %s into memory" % options.fname
+        ntotal = count_entries(options)
+        shards = split_entries(ntotal, options.chunk_size)
+        layer_sets = get_layer_sets(regions)
+        if use_skims(options):
+            keys = make_skims(options, layer_sets, ntotal)
+            skims = dict((layers, load_training_set(options.cache_dir, keys[layers])[0]) for layers in layer_sets)
+            self.events = [(start, stop, dict((layers, slice_events(skims[layers], start, stop)) for layers in layer_sets)) for (start, stop) in shards]
+        else:
+            branches = get_branches(regions)
+            self.events = list(map_shards(extract_shard, [(start, stop, options.fname, branches, layer_sets) for (start, stop) in shards], options.workers))
+        self.events_key = self.input_key(options)
+        self.layer_sets = layer_sets
+        return self.events
+
+    def run(self, regions, options=None):
+        if options is None:
+            options = self.options
+
+        # The events in memory are used if they are the input of this configuration
+        events = None
+        if self.in_memory(regions, options):
+            events = self.events
+
+        if options.lut_bins:
+            return train_lut(regions, options.lut_bins, options, events)
+        return train(regions, options, events)
+
+    def scan(self, get_regions, key, values):
+        # Train once for every value of the option, with the outputs in
+        # <outdir>/<key>_<value>/. Returns the trainers of every value.
+        results = []
+        for value in values:
+            options = copy.copy(self.options)
+            setattr(options, key, value)
+            options.scan = None
+            options.outdir = os.path.join(self.options.outdir, "%s_%s" % (key, str(value).replace(" ", "")))
+            regions = get_regions(options)
+            self.load(regions, options)
+            if options.verbose > 0:
+                print "# Scan: %s = %s" % (key, value)
+            results.append((value, self.run(regions, options)))
+        return results
+
+# ______________________________________________________________________________
+# The regions of a configuration: the trigger towers of the options, or the
+# default region of the geometry
+default_regions = {"barrel": barrel_tt27, "endcap": endcap_tt43}
+
+def get_regions(options, geometry="barrel"):
+    if options.towers:
+        regions = [tower_region(tt, use_3D=options.use_3D) for tt in options.towers]
+    else:
+        regions = [default_regions[geometry](use_3D=options.use_3D)]
+    if options.eta_slices > 1:
+        regions = [r for region in regions for r in eta_slices(region, options.eta_slices)]
+    regions = [set_smearing(region, options.smear_ps, options.smear_2s) for region in regions]
+    if options.pre_estimate:
+        regions = [region.copy(pre_estimate=1) for region in regions]
+    return regions
+
+def main(options, geometry="barrel"):
+    builder = MatrixBuilder(options)
+    if options.scan:
+        return builder.scan(lambda options: get_regions(options, geometry), *options.scan)
+    return builder.run(get_regions(options, geometry))
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    for region in [barrel_tt27(), endcap_tt43()]:
+        print region, get_branches([region])
+
+    # A scan over the input trains every point on its own events, also in one
+    # process (the tree of the first input must not be reused)
+    import tempfile
+    from matrixconfig import make_options
+    fnames = [synthetic_fname("barrel", 20000, seed) for seed in [1, 2]]
+    for workers in [1, 2]:
+        options = make_options(fname=fnames[0], nentries=-1, chunk_size=5000, workers=workers, cache_dir="", ntrials=0, missing_layers=0, fixed_point_bits=[], make_plots=0, verbose=0, outdir=tempfile.mkdtemp())
+        results = MatrixBuilder(options).scan(get_regions, "fname", fnames)
+        trainers = [train(get_regions(options), make_options(**dict(vars(options), fname=fname)))[0] for fname in fnames]
+        print workers, [t.stat_var1.cnt for (fname, (t,)) in results], [np.array_equal(t.stat_var1.v_mean, u.stat_var1.v_mean) for ((fname, (t,)), u) in izip(results, trainers)]
+        shutil.rmtree(options.outdir)
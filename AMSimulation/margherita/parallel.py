@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import collections
+import multiprocessing
+from itertools import islice
+
+# ______________________________________________________________________________
+# Split the entry range [0, nentries) into shards of a fixed size. The shards
+# do not depend on the number of workers, and neither do the results as long
+# as the partial results are reduced in shard order.
+def split_entries(nentries, shard_size):
+    return [(start, min(start+shard_size, nentries)) for start in xrange(0, nentries, shard_size)]
+
+# ______________________________________________________________________________
+# Apply func to every shard in a pool of worker processes. The results are
+# yielded in shard order. At most 2*workers shards are in flight, so that if
+# the caller stops early, the pool only finishes those. (Pool.terminate() can
+# hang while the task queue is being fed.)
+def map_shards(func, shards, workers=1, initializer=None, initargs=()):
+    if workers <= 1:
+        for shard in shards:
+            yield func(shard)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=initializer, initargs=initargs)
+    shards = iter(shards)
+    pending = collections.deque(pool.apply_async(func, (shard,)) for shard in islice(shards, 2*workers))
+    try:
+        while pending:
+            result = pending.popleft().get()
+            for shard in islice(shards, 1):
+                pending.append(pool.apply_async(func, (shard,)))
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    def square(shard):
+        start, stop = shard
+        return sum(i*i for i in xrange(start, stop))
+
+    shards = split_entries(1000003, 100000)
+    print shards
+    print sum(map_shards(square, shards, workers=1))
+    print sum(map_shards(square, shards, workers=4))
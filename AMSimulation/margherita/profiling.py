@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+import json
+import os
+import resource
+import time
+
+# ______________________________________________________________________________
+# Timing instrumentation of the matrix builder steps. Every step records
+#   wall, cpu     : wall-clock and CPU time of the main process [s]
+#   events        : number of events (entries read in step 1, training events after)
+#   bytes_read    : bytes read from the input file
+#   io, numpy, hist: time spent reading/writing files, in numpy and filling
+#                  histograms [s]. With worker processes, the times of all the
+#                  workers are summed, so they can exceed the wall time.
+#   other         : wall time not attributed to any category (main process only)
+#   peak_rss_mb   : peak resident memory of the main process so far
+#
+# A disabled profiler does nothing, so the calls can stay in the code.
+
+categories = ["io", "numpy", "hist"]
+
+def peak_rss_mb(children=False):
+    # ru_maxrss is in kB on Linux
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss / 1024.
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+class Profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.steps = []
+        self.current = None
+
+    @contextmanager
+    def step(self, name, region=None):
+        if not self.enabled:
+            yield
+            return
+
+        entry = {"name": name, "region": region, "events": 0, "bytes_read": 0}
+        for category in categories:
+            entry[category] = 0.
+        self.current = entry
+        t0, c0 = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            entry["wall"] = time.time() - t0
+            entry["cpu"] = cpu_time() - c0
+            entry["events_per_s"] = entry["events"] / entry["wall"] if entry["wall"] > 0 else 0.
+            entry["other"] = max(entry["wall"] - sum(entry[category] for category in categories), 0.)
+            entry["peak_rss_mb"] = peak_rss_mb()
+            self.steps.append(entry)
+            self.current = None
+
+    @contextmanager
+    def timer(self, category):
+        if not self.enabled or self.current is None:
+            yield
+            return
+
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.current[category] += time.time() - t0
+
+    def add(self, **counts):
+        # Add events, bytes_read or the times of another process to the current step
+        if not self.enabled or self.current is None:
+            return
+        for k, v in counts.iteritems():
+            self.current[k] += v
+        return
+
+    def report(self, **info):
+        report = dict(info)
+        report["steps"] = self.steps
+        report["peak_rss_mb"] = peak_rss_mb()
+        report["peak_rss_children_mb"] = peak_rss_mb(children=True)
+        return report
+
+    def write(self, path, **info):
+        if not self.enabled:
+            return
+        tmppath = path + ".tmp%i" % os.getpid()
+        with open(tmppath, "w") as f:
+            json.dump(self.report(**info), f, indent=2, sort_keys=True)
+        os.rename(tmppath, path)
+        return path
+
+    def summary(self):
+        lines = ["%-8s %-16s %9s %9s %12s %9s %9s %9s %9s %9s" % ("step", "region", "wall", "cpu", "events/s", "MB read", "io", "numpy", "hist", "other")]
+        for s in self.steps:
+            lines.append("%-8s %-16s %9.3f %9.3f %12.4g %9.2f %9.3f %9.3f %9.3f %9.3f" % (s["name"], s["region"] or "", s["wall"], s["cpu"], s["events_per_s"], s["bytes_read"] / 1e6, s["io"], s["numpy"], s["hist"], s["other"]))
+        return "\n".join(lines)
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    import numpy as np
+
+    profiler = Profiler()
+    with profiler.step("demo"):
+        with profiler.timer("numpy"):
+            x = np.random.normal(0., 1., (1000000, 6))
+            c = np.cov(x.T)
+        profiler.add(events=len(x))
+        time.sleep(0.1)
+    print profiler.summary()
+    print json.dumps(profiler.report(), indent=2, sort_keys=True)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# ______________________________________________________________________________
+# Reference
+#   Karnin, Lang, Liberty, "Optimal Quantile Approximation in Streams" (2016)
+#   https://arxiv.org/abs/1603.05346
+
+# ______________________________________________________________________________
+# KLL sketch, one per dimension. All the dimensions share the same compactor
+# sizes, so the compactors are stored as (n, d) arrays and every column is
+# sorted and compacted on its own. The normalized rank error scales as 1/k,
+# the memory use is about 3*k*d values.
+class QuantileSketch:
+    def __init__(self, d=1, k=2000, c=2./3, seed=2016):
+        self.d = d
+        self.k = k
+        self.c = c
+        self.rng = np.random.RandomState(seed)
+        self.cnt = 0
+        self.levels = [np.zeros((0,d))]
+        self.pending = []
+        self.sorted_values = None
+        self.sorted_weights = None
+
+    def capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(np.ceil(self.k * self.c**depth)))
+
+    def add(self, variables):
+        self.pending.append(variables)
+        self.cnt += 1
+        if len(self.pending) >= self.k:
+            self._flush()
+        return
+
+    def add_batch(self, variables):
+        assert(variables.ndim == 2 and variables.shape[1] == self.d)
+        if len(variables) == 0:
+            return
+        self._flush()
+        self.levels[0] = np.concatenate((self.levels[0], variables))
+        self.cnt += len(variables)
+        self._compress()
+        return
+
+    def merge(self, other):
+        assert(other.d == self.d)
+        assert(other.k == self.k and other.c == self.c)
+        self._flush()
+        other._flush()
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros((0,self.d)))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h], level))
+        self.cnt += other.cnt
+        self._compress()
+        return
+
+    def select(self, index):
+        # Sketch of a subset of the dimensions, the columns are compacted on
+        # their own so they can be taken as they are
+        self._flush()
+        index = np.asarray(index)
+        result = QuantileSketch(d=len(index), k=self.k, c=self.c)
+        result.rng.set_state(self.rng.get_state())
+        result.cnt = self.cnt
+        result.levels = [level[:, index] for level in self.levels]
+        return result
+
+    def count(self):
+        return self.cnt
+
+    def size(self):
+        return sum(len(level) for level in self.levels) + len(self.pending)
+
+    def quantile(self, p):
+        self._flush()
+        if len(self.levels) == 1:
+            # Nothing compacted yet, the answer is exact
+            return np.percentile(self.levels[0], p*100, axis=0)
+
+        if self.sorted_values is None:
+            values = np.concatenate(self.levels)
+            weights = np.concatenate([np.ones(len(level)) * 2**h for h, level in enumerate(self.levels)])
+            order = np.argsort(values, axis=0, kind='mergesort')
+            columns = np.arange(self.d)
+            self.sorted_values = values[order, columns]
+            self.sorted_weights = np.cumsum(weights[order], axis=0)
+
+        i = (self.sorted_weights < p * self.sorted_weights[-1]).sum(axis=0)
+        i = np.minimum(i, len(self.sorted_values)-1)
+        return self.sorted_values[i, np.arange(self.d)]
+
+    def _flush(self):
+        if not self.pending:
+            return
+        self.levels[0] = np.concatenate((self.levels[0], np.asarray(self.pending).reshape(-1, self.d)))
+        self.pending = []
+        self._compress()
+        return
+
+    def _compress(self):
+        self.sorted_values = None
+        self.sorted_weights = None
+
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.capacity(h):
+                if h+1 == len(self.levels):
+                    self.levels.append(np.zeros((0,self.d)))
+
+                # Keep one item if odd, promote every other item of the sorted rest
+                level = np.sort(level, axis=0)
+                nkeep = len(level) % 2
+                offset = self.rng.randint(2)
+                self.levels[h+1] = np.concatenate((self.levels[h+1], level[nkeep+offset::2]))
+                self.levels[h] = level[:nkeep]
+
+                # Capacities change with the number of levels, start again from the bottom
+                h = 0
+                continue
+            h += 1
+        return
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    d = 6
+    nevents = 1000000
+    myarray = np.random.normal(0., 1., (nevents, d))
+
+    sketch = QuantileSketch(d=d, k=2000)
+    for i in xrange(0, nevents, 10000):
+        sketch.add_batch(myarray[i:i+10000])
+
+    print sketch.count()
+    print sketch.size()
+    for p in [0.01, 0.05, 0.5, 0.95, 0.99]:
+        q = sketch.quantile(p)
+        print p, q
+        print p, (myarray < q).mean(axis=0)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+from math import pi, sinh
+import copy
+import numpy as np
+
+# ______________________________________________________________________________
+# Geometry
+barrel_r_center = np.asarray([22.5913, 35.4772, 50.5402, 68.3101, 88.5002, 107.71])
+endcap_z_center = np.asarray([82.385, 131.344, 156.145, 185.504, 220.258, 261.400])
+
+barrel_layers = [5,6,7,8,9,10]
+endcap_pos_layers = [5,11,12,13,14,15]
+endcap_neg_layers = [5,18,19,20,21,22]
+
+# Uniform z smearing half-widths of the barrel PS and 2S layers
+barrel_smear_ps = 0.075
+barrel_smear_2s = 2.5
+barrel_smear_z = np.asarray([barrel_smear_ps]*3 + [barrel_smear_2s]*3)
+
+par_titles = ["q/p_{T} [1/GeV]", "#phi [rad]", "cot #theta", "z_{0} [cm]"]
+err_titles = ["#Delta q/p_{T} [1/GeV]", "#Delta #phi [rad]", "#Delta cot #theta", "#Delta z_{0} [cm]", "#Delta (p_{T})/p_{T}", "#Delta (q/p_{T})*p_{T}"]
+
+# ______________________________________________________________________________
+# A training region: the track parameter window, the stubs to use and how to
+# build the fit variables from them
+#   geometry     : "barrel" uses (phi, z) vs r, "endcap" uses (phi, r) vs z
+#   layers       : keep only the stubs in these layers (None keeps all of them)
+#   r_center     : reference radii of the deltaR correction (barrel)
+#   z_center     : reference z of the deltaZ correction (endcap)
+#   smear_z      : uniform smearing half-widths of the second coordinate
+#   r3_correction: apply the R^3 correction (barrel)
+#   cut_var2     : also apply the quantile cuts to the second set of variables
+#   pre_estimate : correct the variables with the pre-estimate of invPt and
+#                  cotTheta from the stubs instead of the true values
+#   minPreInvPt, maxPreInvPt, minPreCotTheta, maxPreCotTheta:
+#                  window of the pre-estimate (None for no window)
+#   par_bins     : (nbins, xmin, xmax) of the 4 track parameters in the plots
+#   err_bins     : (nbins, xmin, xmax) of the 6 fit errors in the plots
+class Region:
+    def __init__(self, name, geometry, minInvPt, maxInvPt, minEta, maxEta, minPhi=None, maxPhi=None,
+                 layers=None, r_center=None, z_center=None, smear_z=None, r3_correction=False, cut_var2=True,
+                 use_3D=0, phi_center=None, eta_center=None, par_bins=None, err_bins=None, pre_estimate=0,
+                 minPreInvPt=None, maxPreInvPt=None, minPreCotTheta=None, maxPreCotTheta=None):
+        assert(geometry in ("barrel", "endcap"))
+        self.name = name
+        self.geometry = geometry
+        self.minInvPt = minInvPt
+        self.maxInvPt = maxInvPt
+        self.minEta = minEta
+        self.maxEta = maxEta
+        self.minPhi = minPhi
+        self.maxPhi = maxPhi
+        self.layers = layers
+        self.r_center = r_center
+        self.z_center = z_center
+        self.smear_z = smear_z
+        self.r3_correction = r3_correction
+        self.cut_var2 = cut_var2
+        self.use_3D = use_3D
+        if phi_center is None and minPhi is not None:
+            phi_center = (minPhi + maxPhi)/2
+        if eta_center is None:
+            eta_center = (minEta + maxEta)/2
+        self.phi_center = phi_center
+        self.eta_center = eta_center
+        self.par_bins = par_bins
+        self.err_bins = err_bins
+        self.pre_estimate = pre_estimate
+        self.minPreInvPt = minPreInvPt
+        self.maxPreInvPt = maxPreInvPt
+        self.minPreCotTheta = minPreCotTheta
+        self.maxPreCotTheta = maxPreCotTheta
+
+    def key(self):
+        # Everything that changes the training data
+        fields = [self.geometry, self.minInvPt, self.maxInvPt, self.minEta, self.maxEta, self.minPhi, self.maxPhi,
+                  self.layers, self.r_center, self.z_center, self.smear_z, self.r3_correction, self.cut_var2, self.use_3D]
+        if self.pre_estimate:
+            fields += [self.pre_estimate, self.minPreInvPt, self.maxPreInvPt, self.minPreCotTheta, self.maxPreCotTheta]
+        return [x.tolist() if isinstance(x, np.ndarray) else x for x in fields]
+
+    def to_dict(self):
+        return dict((k, v.tolist() if isinstance(v, np.ndarray) else v) for (k, v) in self.__dict__.iteritems())
+
+    def copy(self, **kwargs):
+        region = copy.copy(self)
+        region.__dict__.update(kwargs)
+        return region
+
+    def __repr__(self):
+        return "Region(%s, %s, invPt=[%g,%g), eta=[%g,%g))" % (self.name, self.geometry, self.minInvPt, self.maxInvPt, self.minEta, self.maxEta)
+
+
+def region_from_dict(d):
+    kwargs = dict((str(k), v) for (k, v) in d.iteritems())
+    kwargs["name"] = str(kwargs["name"])
+    kwargs["geometry"] = str(kwargs["geometry"])
+    for k in ["r_center", "z_center", "smear_z"]:
+        if kwargs[k] is not None:
+            kwargs[k] = np.asarray(kwargs[k])
+    return Region(**kwargs)
+
+
+# ______________________________________________________________________________
+# Build the fit variables of the region from (N, 6) stub coordinates, given the
+# track invPt and cotTheta used in the corrections (the true values in the
+# training, estimates in the fitter). smear is added to the coarse coordinate
+# (z in the barrel, r in the endcap) before the corrections. Everything is
+# computed in the given dtype.
+def make_variables(region, TTStubs_phi, TTStubs_r, TTStubs_z, invPt, cotTheta, smear=None, dtype=np.float64):
+    TTStubs_phi = np.array(TTStubs_phi, dtype=dtype)
+    TTStubs_r = np.array(TTStubs_r, dtype=dtype)
+    TTStubs_z = np.array(TTStubs_z, dtype=dtype)
+    invPt = np.asarray(invPt, dtype=dtype)
+    cotTheta = np.asarray(cotTheta, dtype=dtype)
+
+    simC = -0.5 * (0.003 * 3.811 * invPt[:, np.newaxis])  # 1/(2 x radius of curvature)
+
+    if region.geometry == "barrel":
+        # Get stub variables
+        variables1 = TTStubs_phi
+        variables2 = TTStubs_z
+        variables3 = TTStubs_r - np.asarray(region.r_center, dtype=dtype)  # deltaR
+        simT = cotTheta[:, np.newaxis]
+
+    else:
+        tanTheta = 1.0/cotTheta
+
+        # Exchange barrel z measurement for r, and r constant for z
+        for lay in [0,]:
+            TTStubs_r[:,lay], TTStubs_z[:,lay] = TTStubs_z[:,lay] * tanTheta, TTStubs_r[:,lay] * cotTheta
+
+        # Get stub variables
+        variables1 = TTStubs_phi
+        variables2 = TTStubs_r
+        variables3 = TTStubs_z - np.asarray(region.z_center, dtype=dtype)  # deltaZ
+        simC = simC * tanTheta[:, np.newaxis]
+        simT = tanTheta[:, np.newaxis]
+
+    if smear is not None:
+        variables2 += smear
+
+    # Apply deltaR (deltaZ) correction
+    variables1 -= simC * variables3
+    variables2 -= simT * variables3
+
+    # Apply R^3 correction
+    if region.r3_correction:
+        r_over_two_rho_term = np.power(TTStubs_r * simC, 3)
+        r_over_two_rho_term *= 1.0/6.0
+        r_over_two_rho_term_z = np.divide(r_over_two_rho_term, simC, out=np.zeros_like(r_over_two_rho_term), where=(simC != 0))
+        variables1 -= r_over_two_rho_term
+        variables2 -= r_over_two_rho_term_z
+    return variables1, variables2
+
+# ______________________________________________________________________________
+# Pre-estimate of invPt and cotTheta from the slopes of phi and z vs r between
+# two stubs, by default the innermost and the outermost ones
+def pre_estimate(TTStubs_phi, TTStubs_r, TTStubs_z, first=0, last=-1):
+    deltaR = TTStubs_r[:,last] - TTStubs_r[:,first]
+    deltaPhi = (TTStubs_phi[:,last] - TTStubs_phi[:,first] + pi) % (2*pi) - pi
+    invPt = (deltaPhi / deltaR) / (-0.5 * 0.003 * 3.811)
+    cotTheta = (TTStubs_z[:,last] - TTStubs_z[:,first]) / deltaR
+    return invPt, cotTheta
+
+
+# ______________________________________________________________________________
+# Get the parameter space of a trigger tower (see res1/helper.py)
+def get_parameter_space(tt):
+    ieta = tt/8
+    iphi = tt%8
+    etamin = -2.2 + (4.4/6) * ieta
+    etamax = -2.2 + (4.4/6) * (ieta+1)
+    phimin = -pi/2 + (2*pi/8) * iphi
+    phimax = -pi/2 + (2*pi/8) * (iphi+1)
+    if iphi >= 6:
+        phimin -= 2*pi
+        phimax -= 2*pi
+    return (phimin, phimax, etamin, etamax)
+
+# ______________________________________________________________________________
+# Predefined regions
+def barrel_tt27(use_3D=0):
+    par_bins = [(20, -0.5, 0.5), (20, pi/4, pi/2), (20, 0., 0.8), (20, -15., 15.)]
+    err_bins = [(1000, -0.015, 0.015), (1000, -0.005, 0.005), (1000, -0.03, 0.03), (1000, -1.2, 1.2), (1000, -0.2, 0.2), (1000, -0.2, 0.2)]
+    return Region("tt27", "barrel", -1.0/3, +1.0/3, 0.0, 2.2/3,
+                  r_center=barrel_r_center, smear_z=barrel_smear_z, r3_correction=True, cut_var2=True,
+                  use_3D=use_3D, phi_center=pi*3/8, eta_center=2.2/6, par_bins=par_bins, err_bins=err_bins)
+
+def endcap_tt43(use_3D=1):
+    par_bins = [(20, -0.1, 0.1), (20, pi/4, pi/2), (20, 2., 5.), (20, -15, 15)]
+    err_bins = [(1000, -0.05, 0.05), (1000, -0.005, 0.005), (1000, -8-0.3, -8+0.3), (1000, -1.2, 1.2), (1000, -2., 2.), (1000, -2., 2.)]
+    #return Region("tt43", "endcap", -1.0/10., +1.0/10., 1.6, 2.4, ...)
+    return Region("tt43", "endcap", -1.0/10., +1.0/10., 2.05, 2.15,
+                  layers=endcap_pos_layers, z_center=endcap_z_center, r3_correction=False, cut_var2=False,
+                  use_3D=use_3D, phi_center=pi*3/8, eta_center=(1.6+2.4)/2, par_bins=par_bins, err_bins=err_bins)
+
+def tower_region(tt, use_3D=0, minInvPt=None, maxInvPt=None):
+    phimin, phimax, etamin, etamax = get_parameter_space(tt)
+    ieta = tt/8
+    if ieta in (2, 3):
+        if minInvPt is None:
+            minInvPt, maxInvPt = -1.0/3, +1.0/3
+        region = barrel_tt27(use_3D=use_3D)
+        region = region.copy(layers=barrel_layers)
+    elif ieta in (0, 5):
+        if minInvPt is None:
+            minInvPt, maxInvPt = -1.0/10., +1.0/10.
+        region = endcap_tt43(use_3D=use_3D)
+        if ieta == 0:
+            region = region.copy(layers=endcap_neg_layers, z_center=-endcap_z_center)
+    else:
+        raise ValueError("Trigger tower %i is in the barrel-endcap transition, which is not supported" % tt)
+
+    par_bins = list(region.par_bins)
+    par_bins[0] = (20, minInvPt*1.5, maxInvPt*1.5)
+    par_bins[1] = (20, phimin, phimax)
+    par_bins[2] = (20, sinh(etamin), sinh(etamax))
+    return region.copy(name="tt%i" % tt, minInvPt=minInvPt, maxInvPt=maxInvPt, minEta=etamin, maxEta=etamax,
+                       minPhi=phimin, maxPhi=phimax, phi_center=(phimin+phimax)/2, eta_center=(etamin+etamax)/2, par_bins=par_bins)
+
+# Change the smearing half-widths of the PS (inner 3) and 2S (outer 3) layers of
+# a barrel region, None keeps the current ones. The endcap regions are not
+# smeared and are returned as they are.
+def set_smearing(region, smear_ps=None, smear_2s=None):
+    if region.geometry != "barrel" or (smear_ps is None and smear_2s is None):
+        return region
+    smear_z = np.array(barrel_smear_z if region.smear_z is None else region.smear_z, dtype=np.float64)
+    if smear_ps is not None:
+        smear_z[:3] = smear_ps
+    if smear_2s is not None:
+        smear_z[3:] = smear_2s
+    return region.copy(smear_z=smear_z)
+
+def eta_slices(region, nslices):
+    edges = np.linspace(region.minEta, region.maxEta, nslices+1)
+    return [region.copy(name="%s_eta%i" % (region.name, i), minEta=edges[i], maxEta=edges[i+1], eta_center=(edges[i]+edges[i+1])/2) for i in xrange(nslices)]
+
+# Bin edges of the lookup table of constants in the pre-estimated invPt and
+# cotTheta, and one region per bin (in row-major order). The outer bins are
+# open-ended, as the pre-estimates outside the table use the closest bin.
+def lut_edges(region, nbins_invPt, nbins_cotTheta):
+    invPt_edges = np.linspace(region.minInvPt, region.maxInvPt, nbins_invPt+1)
+    cotTheta_edges = np.sinh(np.linspace(region.minEta, region.maxEta, nbins_cotTheta+1))
+    return invPt_edges, cotTheta_edges
+
+def lut_regions(region, nbins_invPt, nbins_cotTheta):
+    invPt_edges, cotTheta_edges = lut_edges(region, nbins_invPt, nbins_cotTheta)
+    invPt_edges[0], invPt_edges[-1] = -np.inf, np.inf
+    cotTheta_edges[0], cotTheta_edges[-1] = -np.inf, np.inf
+    return [region.copy(name="%s_lut%i_%i" % (region.name, i, j), pre_estimate=1,
+                        minPreInvPt=invPt_edges[i], maxPreInvPt=invPt_edges[i+1], minPreCotTheta=cotTheta_edges[j], maxPreCotTheta=cotTheta_edges[j+1])
+            for i in xrange(nbins_invPt) for j in xrange(nbins_cotTheta)]
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    print barrel_tt27()
+    print endcap_tt43()
+    for tt in [16, 27, 40, 43, 0]:
+        region = tower_region(tt)
+        print region, region.minPhi, region.maxPhi, region.layers
+    for region in eta_slices(endcap_tt43(), 4):
+        print region
+    print region_from_dict(barrel_tt27().to_dict()).key() == barrel_tt27().key()
+    print set_smearing(barrel_tt27(), smear_2s=1.0).smear_z, set_smearing(endcap_tt43(), 0.1, 1.0).smear_z
+    for region in lut_regions(barrel_tt27(), 2, 2):
+        print region, region.minPreInvPt, region.maxPreInvPt, region.minPreCotTheta, region.maxPreCotTheta
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# ______________________________________________________________________________
+# Counter-based random numbers for the stub smearing. The number drawn for
+# (seed, entry, column) is a hash of the three, so it does not depend on the
+# order in which the events are processed, on the chunk size, on the number of
+# workers or on which other events pass the selection.
+#
+# Reference
+#   http://prng.di.unimi.it/splitmix64.c
+
+golden_gamma = np.uint64(0x9E3779B97F4A7C15)
+mix1 = np.uint64(0xBF58476D1CE4E5B9)
+mix2 = np.uint64(0x94D049BB133111EB)
+
+def splitmix64(x):
+    # Finalizer of SplitMix64 on an array of uint64, the arithmetic wraps around
+    z = np.array(x, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        z = (z ^ (z >> np.uint64(30))) * mix1
+        z = (z ^ (z >> np.uint64(27))) * mix2
+        z = z ^ (z >> np.uint64(31))
+    return z
+
+def counter_uniform(seed, entries, ncols=6, low=-1., high=1.):
+    # (N, ncols) uniform numbers in [low, high) for the given entry numbers.
+    # Element (entry, col) is the (entry*ncols + col)-th number of the
+    # SplitMix64 sequence started from the hashed seed.
+    entries = np.asarray(entries, dtype=np.uint64)
+    key = splitmix64(np.uint64(seed))
+    with np.errstate(over="ignore"):
+        counter = entries[:,np.newaxis] * np.uint64(ncols) + np.arange(ncols, dtype=np.uint64)
+        z = splitmix64(key + (counter + np.uint64(1)) * golden_gamma)
+    u = (z >> np.uint64(11)).astype(np.float64) * (1.0 / 2**53)
+    return low + (high - low) * u
+
+def smear_stubs(seed, entries, widths):
+    # Uniform smearing in [-widths, widths) of the 6 stubs of every entry
+    widths = np.asarray(widths, dtype=np.float64)
+    return counter_uniform(seed, entries, len(widths)) * widths
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    # Reference values of splitmix64.c with the state starting at 1234567
+    state = np.uint64(1234567) + golden_gamma * np.arange(1, 6, dtype=np.uint64)
+    print [hex(long(x)) for x in splitmix64(state)]
+
+    entries = np.arange(1000000)
+    u = counter_uniform(2016, entries)
+    print u.shape, u.min(), u.max(), u.mean(), u.var(), 1./3
+    print np.array_equal(u[1234:5678], counter_uniform(2016, entries[1234:5678]))
+    print np.array_equal(u[::7], counter_uniform(2016, entries[::7]))
+    print np.corrcoef(u[:,0], u[:,1])[0,1], np.corrcoef(u[:-1,0], u[1:,0])[0,1]
+    print smear_stubs(2016, [0, 1], [0.075, 0.075, 0.075, 2.5, 2.5, 2.5])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import struct
+import numpy as np
+
+# ______________________________________________________________________________
+# Growable contiguous storage of (N, d) rows, e.g. the training data of a
+# region. The rows are copied into one preallocated buffer, which grows by at
+# least chunk_rows rows (and by half of its size) when full. The buffer is
+# reallocated in place when possible, so that growing does not need twice the
+# memory as concatenating the chunks at the end would.
+#
+# array() returns a view of the filled rows without copying. The view must not
+# be used after the next append(), which may move the buffer.
+
+class GrowableArray:
+    def __init__(self, d, dtype=np.float64, capacity=0, chunk_rows=65536):
+        self.d = d
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.n = 0
+        self.buffer = np.empty((capacity, d), dtype=self.dtype)
+
+    def __len__(self):
+        return self.n
+
+    def capacity(self):
+        return len(self.buffer)
+
+    def reserve(self, capacity):
+        if capacity > len(self.buffer):
+            if self.buffer.base is None and self.buffer.flags.owndata:
+                self.buffer.resize((capacity, self.d), refcheck=False)
+            else:
+                buffer = np.empty((capacity, self.d), dtype=self.dtype)
+                buffer[:self.n] = self.buffer[:self.n]
+                self.buffer = buffer
+        return
+
+    def append(self, x):
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[np.newaxis, :]
+        assert(x.ndim == 2 and x.shape[1] == self.d)
+        n = len(x)
+        if self.n + n > len(self.buffer):
+            self.reserve(max(self.n + n, len(self.buffer) + max(self.chunk_rows, len(self.buffer)//2)))
+        self.buffer[self.n:self.n+n] = x
+        self.n += n
+        return
+
+    def array(self):
+        return self.buffer[:self.n]
+
+    def trim(self):
+        # Release the unused capacity, returns the filled rows
+        if self.n < len(self.buffer):
+            if self.buffer.base is None and self.buffer.flags.owndata:
+                self.buffer.resize((self.n, self.d), refcheck=False)
+            else:
+                self.buffer = self.buffer[:self.n].copy()
+        return self.buffer
+
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["buffer"] = self.array()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffer = np.array(self.buffer, dtype=self.dtype)
+
+
+# ______________________________________________________________________________
+# Growable storage of (N, d) rows on disk, for the data that do not fit in
+# memory. The rows are appended to a .npy file, whose header is rewritten with
+# the final shape by close(), so that it can be memory-mapped with np.load.
+# With d=None the rows are scalars and the array is 1-D.
+
+def npy_header(shape, dtype, size=128):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(size - 10 - 1) + "\n"
+    assert(len(header) == size - 10)
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header
+
+class DiskArray:
+    def __init__(self, path, d, dtype=np.float64):
+        self.path = path
+        self.d = d
+        self.row_shape = () if d is None else (d,)
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        self.f = open(path, "wb")
+        self.f.write(npy_header((0,) + self.row_shape, self.dtype))
+
+    def __len__(self):
+        return self.n
+
+    def append(self, x):
+        x = np.ascontiguousarray(x, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self.f.write(x.tobytes())
+        self.n += len(x)
+        return
+
+    def close(self):
+        if self.f is not None:
+            self.f.seek(0)
+            self.f.write(npy_header((self.n,) + self.row_shape, self.dtype))
+            self.f.close()
+            self.f = None
+        return self.path
+
+    def array(self, mmap_mode="r"):
+        # The filled rows, memory-mapped (an empty file cannot be mapped)
+        self.close()
+        if self.n == 0:
+            return np.zeros((0,) + self.row_shape, dtype=self.dtype)
+        return np.load(self.path, mmap_mode=mmap_mode)
+
+
+# ______________________________________________________________________________
+# The computations on blocks of the stored rows are done in float64, whatever
+# the storage type
+def float64_block(x):
+    return np.asarray(x, dtype=np.float64)
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    import resource
+
+    d = 6
+    chunks = [np.random.normal(0., 1., (np.random.randint(1, 100000), d)) for i in xrange(50)]
+    reference = np.concatenate(chunks)
+
+    for dtype in [np.float64, np.float32]:
+        storage = GrowableArray(d, dtype=dtype)
+        for x in chunks:
+            storage.append(x)
+        data = storage.trim()
+        print dtype.__name__, data.shape, data.flags.c_contiguous, storage.nbytes() / 1e6, "MB", np.abs(data - reference).max()
+
+    storage = GrowableArray(d, capacity=len(reference))
+    storage.append(reference)
+    print storage.capacity() == len(reference), np.array_equal(storage.array(), reference)
+
+    import os, tempfile
+    path = os.path.join(tempfile.mkdtemp(), "data.npy")
+    storage = DiskArray(path, d)
+    for x in chunks:
+        storage.append(x)
+    data = storage.array()
+    print type(data).__name__, data.shape, np.array_equal(data, reference), np.array_equal(np.load(path), reference)
+    os.remove(path)
+
+    storage = DiskArray(path, None, dtype=np.int64)
+    for x in chunks:
+        storage.append(np.arange(len(x)))
+    print storage.array().shape, np.array_equal(storage.array(), np.concatenate([np.arange(len(x)) for x in chunks]))
+    os.remove(path)
+    print "peak RSS [MB]: ", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+from math import pi
+import numpy as np
+
+from columnar import jagged_from_counts
+from regions import barrel_r_center, endcap_z_center, barrel_layers, endcap_pos_layers, endcap_neg_layers
+from smearing import counter_uniform
+
+# ______________________________________________________________________________
+# Synthetic single-muon events with 6 stubs on a helix, in the branch layout of
+# the ntuple (genParts_*, TTStubs_*), to measure the matrix builder without the
+# real input. Every event is made from the random numbers of (seed, entry), so
+# that any entry range can be made on the fly and is the same however the input
+# is split into chunks or workers.
+#
+# The barrel stubs are on the layers at r_center, the endcap stubs on the
+# innermost barrel layer and on the disks at z_center. The stubs are at the
+# center of the strip crossed by the track:
+#   phi: uniform within the strip pitch (PS 100 um, 2S 90 um)
+#   r  : uniform within the strip length in the endcap (PS 1.5 mm, 2S 5 cm)
+# The barrel z is exact, as the training smears it with the same widths
+# (barrel_smear_z in regions.py).
+#
+# A few events fail the selection of the builder: no particle or 2 particles,
+# one layer without stub or one layer with 2 stubs.
+
+ncolumns = 48   # random numbers per event
+
+ps_phi_pitch = 0.0100
+ss_phi_pitch = 0.0090
+ps_length = 0.15
+ss_length = 5.0
+endcap_ps_rmax = 60.
+
+# Ranges of the generated parameters (invPt, phi, eta) and the vz spread,
+# slightly larger than the default regions
+generator_ranges = {
+    "barrel": {"invPt": (-0.4, 0.4), "phi": (pi/4 - 0.2, pi/2 + 0.2), "eta": (-0.1, 2.2/3 + 0.1), "sigma_vz": 5.},
+    "endcap": {"invPt": (-0.15, 0.15), "phi": (pi/4 - 0.2, pi/2 + 0.2), "eta": (1.95, 2.25), "sigma_vz": 5.},
+}
+
+# Probabilities of the events that fail the selection
+p_no_particle = 0.02
+p_two_particles = 0.03
+p_missing_stub = 0.05
+p_extra_stub = 0.05
+
+def uniform_range(u, lohi):
+    return lohi[0] + (lohi[1] - lohi[0]) * u
+
+def gaussian(u1, u2):
+    # Box-Muller, u1 in [0, 1)
+    return np.sqrt(-2. * np.log1p(-u1)) * np.cos(2 * pi * u2)
+
+def helix_barrel(invPt, phi0, cotTheta, vz, r):
+    # Stubs of the helix at the given (N, 6) radii
+    simC = (-0.5 * 0.003 * 3.811 * invPt)[:, np.newaxis]
+    x = r * simC
+    arc = np.arcsin(x)
+    s = np.where(x != 0, r * arc / np.where(x != 0, x, 1.), r)  # path length in the transverse plane
+    return phi0[:, np.newaxis] + arc, vz[:, np.newaxis] + cotTheta[:, np.newaxis] * s
+
+def helix_endcap(invPt, phi0, cotTheta, vz, z):
+    # Stubs of the helix at the given (N, 6) z positions
+    simC = (-0.5 * 0.003 * 3.811 * invPt)[:, np.newaxis]
+    s = (z - vz[:, np.newaxis]) / cotTheta[:, np.newaxis]
+    y = simC * s
+    r = np.where(y != 0, np.sin(y) / np.where(y != 0, simC, 1.), s)
+    return phi0[:, np.newaxis] + y, r
+
+def generate_columns(entries, geometry="barrel", seed=2016, ranges=None):
+    if ranges is None:
+        ranges = generator_ranges[geometry]
+    entries = np.asarray(entries)
+    n = len(entries)
+    u = counter_uniform(seed, entries, ncolumns, 0., 1.)
+
+    # Particles, the second one is only there to fail the selection
+    invPt = uniform_range(u[:,0], ranges["invPt"])
+    phi0 = uniform_range(u[:,1], ranges["phi"])
+    eta = uniform_range(u[:,2], ranges["eta"])
+    vz = ranges["sigma_vz"] * gaussian(u[:,3], u[:,4])
+    cotTheta = np.sinh(eta)
+    gcounts = np.where(u[:,5] < p_no_particle, 0, np.where(u[:,5] >= 1. - p_two_particles, 2, 1))
+
+    invPt2 = uniform_range(u[:,6], ranges["invPt"])
+    phi2 = uniform_range(u[:,7], ranges["phi"])
+    eta2 = uniform_range(u[:,8], ranges["eta"])
+    vz2 = ranges["sigma_vz"] * gaussian(u[:,9], u[:,10])
+
+    # Stubs, in layer order
+    if geometry == "barrel":
+        r = barrel_r_center + (u[:,12:18] - 0.5)
+        TTStubs_phi, TTStubs_z = helix_barrel(invPt, phi0, cotTheta, vz, r)
+        layers = np.asarray(barrel_layers)
+        ps = np.arange(6) < 3
+        TTStubs_phi += np.where(ps, ps_phi_pitch, ss_phi_pitch) / r * (u[:,18:24] - 0.5)
+    else:
+        sign = np.where(eta >= 0, 1., -1.)[:, np.newaxis]
+        z = sign * (endcap_z_center + (u[:,12:18] - 0.5))
+        TTStubs_phi, r = helix_endcap(invPt, phi0, cotTheta, vz, z)
+        TTStubs_z = z.copy()
+        layers = np.where(sign > 0, endcap_pos_layers, endcap_neg_layers)
+
+        # The first stub is on the innermost barrel layer
+        r0 = barrel_r_center[0] + (u[:,12:13] - 0.5)
+        TTStubs_phi[:,:1], TTStubs_z[:,:1] = helix_barrel(invPt, phi0, cotTheta, vz, r0)
+        r[:,:1] = r0
+        ps = (r < endcap_ps_rmax)
+        TTStubs_phi += np.where(ps, ps_phi_pitch, ss_phi_pitch) / r * (u[:,18:24] - 0.5)
+        smear_r = np.where(ps, ps_length, ss_length) * (u[:,24:30] - 0.5)
+        smear_r[:,0] = 0.
+        r += smear_r
+    TTStubs_modId = np.broadcast_to(layers * 10000, (n, 6)) + (np.floor(u[:,30:36] * 100) * 100).astype(np.int64)
+
+    # Slot 2k is the stub of layer k, slot 2k+1 is an extra stub in the same
+    # layer (a second hit in the module)
+    missing = np.where(u[:,36] < p_missing_stub, np.floor(u[:,37] * 6), -1)
+    extra = np.where(u[:,38] < p_extra_stub, np.floor(u[:,39] * 6), -1)
+    keep = np.zeros((n, 12), dtype=bool)
+    keep[:,0::2] = np.arange(6) != missing[:, np.newaxis]
+    keep[:,1::2] = np.arange(6) == extra[:, np.newaxis]
+
+    def slots(x, offset=0.):
+        result = np.empty((n, 12), dtype=x.dtype)
+        result[:,0::2] = x
+        result[:,1::2] = x + offset
+        return result[keep]
+
+    dphi = (u[:,40:46] - 0.5) * 0.01
+    scounts = keep.sum(axis=1)
+    first = gcounts >= 1
+    second = gcounts == 2
+
+    def particles(x1, x2, dtype):
+        x = np.empty((n, 2), dtype=dtype)
+        x[:,0], x[:,1] = x1, x2
+        return x[np.column_stack((first, second))]
+
+    charge = np.where(invPt >= 0, 1, -1)
+    charge2 = np.where(invPt2 >= 0, 1, -1)
+    pt = 1. / np.maximum(np.abs(invPt), 1e-6)
+    pt2 = 1. / np.maximum(np.abs(invPt2), 1e-6)
+
+    columns = {
+        "genParts_pt": jagged_from_counts(gcounts, particles(pt, pt2, np.float32)),
+        "genParts_phi": jagged_from_counts(gcounts, particles(phi0, phi2, np.float32)),
+        "genParts_eta": jagged_from_counts(gcounts, particles(eta, eta2, np.float32)),
+        "genParts_vz": jagged_from_counts(gcounts, particles(vz, vz2, np.float32)),
+        "genParts_charge": jagged_from_counts(gcounts, particles(charge, charge2, np.int32)),
+        "TTStubs_phi": jagged_from_counts(scounts, slots(TTStubs_phi, dphi).astype(np.float32)),
+        "TTStubs_r": jagged_from_counts(scounts, slots(r).astype(np.float32)),
+        "TTStubs_z": jagged_from_counts(scounts, slots(TTStubs_z).astype(np.float32)),
+        "TTStubs_modId": jagged_from_counts(scounts, slots(TTStubs_modId).astype(np.uint32)),
+    }
+    return columns
+
+# ______________________________________________________________________________
+# A tree of synthetic events, made on the fly by read_columns (see columnar.py).
+# The input name synthetic:<geometry>:<nentries>[:<seed>] can be used instead of
+# a ROOT file, e.g. --fname synthetic:barrel:1000000
+class SyntheticTree:
+    def __init__(self, geometry="barrel", nentries=1000000, seed=2016):
+        assert(geometry in generator_ranges)
+        self.geometry = geometry
+        self.nentries = nentries
+        self.seed = seed
+
+    def GetEntries(self):
+        return self.nentries
+
+    def read_columns(self, branches, start, stop):
+        columns = generate_columns(np.arange(start, stop), self.geometry, self.seed)
+        return dict((b, columns[b]) for b in branches)
+
+def synthetic_fname(geometry, nentries, seed=2016):
+    return "synthetic:%s:%i:%i" % (geometry, nentries, seed)
+
+def open_synthetic(fname):
+    # Returns None if fname is not a synthetic input
+    if not fname.startswith("synthetic:"):
+        return None
+    fields = fname.split(":")[1:]
+    if len(fields) not in (2, 3):
+        raise ValueError("Synthetic input must be synthetic:<geometry>:<nentries>[:<seed>]: %s" % fname)
+    return SyntheticTree(*([fields[0]] + [int(x) for x in fields[1:]]))
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    from regions import pre_estimate
+
+    for geometry in ["barrel", "endcap"]:
+        tree = open_synthetic(synthetic_fname(geometry, 100000))
+        columns = tree.read_columns(["genParts_pt", "genParts_charge", "TTStubs_phi", "TTStubs_r", "TTStubs_z", "TTStubs_modId"], 0, tree.GetEntries())
+        print geometry, np.bincount(columns["genParts_pt"].counts()), np.bincount(columns["TTStubs_phi"].counts())
+
+        # The same events in another chunk
+        other = tree.read_columns(["TTStubs_phi"], 1234, 5678)["TTStubs_phi"]
+        print np.array_equal(other.content, columns["TTStubs_phi"].content[columns["TTStubs_phi"].offsets[1234]:columns["TTStubs_phi"].offsets[5678]])
+
+        # The pre-estimate of invPt from the stubs follows the generated one
+        sel = (columns["genParts_pt"].counts() == 1) & (columns["TTStubs_phi"].counts() == 6)
+        invPt = columns["genParts_charge"].first(sel) / columns["genParts_pt"].first(sel)
+        stubs = [columns[b].regular(6, sel).astype(np.float64) for b in ["TTStubs_phi", "TTStubs_r", "TTStubs_z"]]
+        print sel.sum(), np.corrcoef(invPt, pre_estimate(*stubs)[0])[0,1], np.unique(columns["TTStubs_modId"].regular(6, sel) // 10000)
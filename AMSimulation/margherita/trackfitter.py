@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+from math import pi
+import time
+import numpy as np
+
+from constants import *
+from incrementalstats import IncrementalStats
+from regions import *
+
+# ______________________________________________________________________________
+# Linearized track fitter with the constants of one region. The stubs of N
+# combinations are given as (N, 6) phi, z, r arrays, all the combinations are
+# fitted at once. The parameters are D var + b, D is solved for the centred
+# variables and parameters and b = mean(par) - D mean(var).
+#
+# The deltaR (deltaZ) corrections depend on the track invPt and cotTheta. The
+# first pass uses the slopes of phi and z vs r between the innermost and the
+# outermost stubs, every further pass uses the parameters of the previous one.
+# The constants of a region trained with the pre-estimate only take one pass.
+#
+# The chi2 is the sum of the squares of the normalized principal components
+# that are not used for the track parameters, i.e. the (nvariables -
+# nparameters) components with the smallest eigenvalues.
+#
+# Precision emulation:
+#   dtype    : float type of the whole computation (e.g. np.float32)
+#   var_bits : signed width of the fit variables, one value or one per variable.
+#              The LSB of every variable is set by its range in the training.
+#   d_bits   : signed width of the D constants (and of the offsets b), with one
+#              LSB per row
+#   v_bits   : signed width of the V constants, with one LSB per row
+# With var_bits, the variables and the constants are rounded to their fixed-
+# point values and the products are summed exactly (wide accumulator).
+#
+# With the constants of a missing layer (5/6), the stubs are still given as
+# (N, 6) arrays, and the stubs of the missing layer are ignored.
+
+# The offsets that go with D rounded to d_bits and V rounded to v_bits (0 if
+# not rounded). Rounding D to D_q shifts the parameters by (D_q - D) mean(var),
+# the offsets b take it back, so that the rounding does not bias the fit. In
+# the same way, mean_pc is V_q mean(var), so that the rounding of V does not
+# bias the chi2. mean(var) = V^T mean_pc, as V is orthogonal. Also for the
+# stacked constants of a lookup table.
+def rounded_offsets(constants, d_bits, v_bits):
+    constants = dict(constants)
+    for i in (1, 2):
+        V = np.asarray(constants["V_var%i" % i], dtype=np.float64)
+        mean_var = np.einsum("...ji,...j->...i", V, constants["mean_pc%i" % i])
+        if d_bits:
+            D = np.asarray(constants["D_var%i" % i], dtype=np.float64)
+            D_q = dequantize(*quantize(D, d_bits))
+            constants["b_var%i" % i] = constants["b_var%i" % i] + np.einsum("...ij,...j->...i", D - D_q, mean_var)
+        if v_bits:
+            V_q = dequantize(*quantize(V, v_bits))
+            constants["mean_pc%i" % i] = np.einsum("...ij,...j->...i", V_q, mean_var)
+    return constants
+
+class TrackFitter:
+    def __init__(self, region, constants, dtype=np.float64, var_bits=0, d_bits=0, v_bits=0, missing_layer=None):
+        self.region = region
+        self.use_3D = region.use_3D
+        self.dtype = dtype
+        self.var_bits = var_bits
+        self.missing_layer = missing_layer
+        self.layers = [i for i in xrange(6) if i != missing_layer]
+
+        V_var1, V_var2 = constants["V_var1"], constants["V_var2"]
+        if "b_var1" not in constants:
+            raise ValueError("The constants have no parameter offsets (b_var1, b_var2), they must be retrained")
+        constants = rounded_offsets(constants, d_bits, v_bits)
+        D_var1, D_var2 = constants["D_var1"], constants["D_var2"]
+        b_var1, b_var2 = constants["b_var1"], constants["b_var2"]
+        if d_bits:
+            D_var1, D_var2 = dequantize(*quantize(D_var1, d_bits)), dequantize(*quantize(D_var2, d_bits))
+            b_var1, b_var2 = dequantize(*quantize(b_var1, d_bits)), dequantize(*quantize(b_var2, d_bits))
+        if v_bits:
+            V_var1, V_var2 = dequantize(*quantize(V_var1, v_bits)), dequantize(*quantize(V_var2, v_bits))
+        if var_bits:
+            if "absmax_var1" not in constants:
+                raise ValueError("The constants have no variable ranges, needed for the fixed-point LSBs")
+            self.var_frac1 = fixed_point_frac(constants["absmax_var1"], var_bits)
+            self.var_frac2 = fixed_point_frac(constants["absmax_var2"], var_bits)
+
+        self.V_var1 = np.asarray(V_var1, dtype=dtype)
+        self.V_var2 = np.asarray(V_var2, dtype=dtype)
+        self.D_var1 = np.asarray(D_var1, dtype=dtype)
+        self.D_var2 = np.asarray(D_var2, dtype=dtype)
+        self.b_var1 = np.asarray(b_var1, dtype=dtype)
+        self.b_var2 = np.asarray(b_var2, dtype=dtype)
+        self.mean_pc1 = np.asarray(constants["mean_pc1"], dtype=dtype)
+        self.mean_pc2 = np.asarray(constants["mean_pc2"], dtype=dtype)
+        self.scale1 = self.normalization(constants["w_var1"])
+        self.scale2 = self.normalization(constants["w_var2"])
+
+        # Number of non-leading principal components (eigenvalues in ascending order)
+        self.nchi2_1 = self.V_var1.shape[0] - self.D_var1.shape[0]
+        self.nchi2_2 = self.V_var2.shape[0] - self.D_var2.shape[0]
+        if self.use_3D:
+            self.ndof = self.nchi2_1
+        else:
+            self.ndof = self.nchi2_1 + self.nchi2_2
+
+    def normalization(self, w):
+        w = np.asarray(w)
+        scale = np.zeros(len(w))
+        scale[np.abs(w) > 1e-14] = 1.0/np.sqrt(w[np.abs(w) > 1e-14])
+        return scale.astype(self.dtype)
+
+    def to_fixed_point(self, variables, frac):
+        return round_to_fixed(variables, frac, self.var_bits) * np.power(2.0, -frac)
+
+    def fit_variables(self, variables1, variables2):
+        variables1 = np.asarray(variables1, dtype=self.dtype)
+        variables2 = np.asarray(variables2, dtype=self.dtype)
+        if self.use_3D:
+            variables1 = np.hstack((variables1, variables2))
+        if self.var_bits:
+            variables1 = self.to_fixed_point(variables1, self.var_frac1).astype(self.dtype)
+            if not self.use_3D:
+                variables2 = self.to_fixed_point(variables2, self.var_frac2).astype(self.dtype)
+
+        if self.use_3D:
+            parameters = np.dot(variables1, self.D_var1.T) + self.b_var1
+        else:
+            parameters = np.hstack((np.dot(variables1, self.D_var1.T) + self.b_var1, np.dot(variables2, self.D_var2.T) + self.b_var2))
+
+        # Non-leading principal components
+        npc1 = (np.dot(variables1, self.V_var1[:self.nchi2_1].T) - self.mean_pc1[:self.nchi2_1]) * self.scale1[:self.nchi2_1]
+        chi2 = (npc1 * npc1).sum(axis=1)
+        if not self.use_3D:
+            npc2 = (np.dot(variables2, self.V_var2[:self.nchi2_2].T) - self.mean_pc2[:self.nchi2_2]) * self.scale2[:self.nchi2_2]
+            chi2 += (npc2 * npc2).sum(axis=1)
+        return parameters, chi2
+
+    def fit(self, phi, z, r, niter=2, block_size=100000):
+        # Returns the (N, 4) parameters (invPt, phi, cotTheta, z0) and the (N,) chi2
+        phi, z, r = np.asarray(phi), np.asarray(z), np.asarray(r)
+        assert(phi.shape == z.shape == r.shape and phi.ndim == 2 and phi.shape[1] == 6)
+
+        n = len(phi)
+        parameters = np.zeros((n, 4), dtype=self.dtype)
+        chi2 = np.zeros(n, dtype=self.dtype)
+        for i in xrange(0, n, block_size):
+            TTStubs_phi, TTStubs_z, TTStubs_r = phi[i:i+block_size], z[i:i+block_size], r[i:i+block_size]
+
+            TTStubs_phi, TTStubs_z, TTStubs_r = TTStubs_phi.astype(self.dtype), TTStubs_z.astype(self.dtype), TTStubs_r.astype(self.dtype)
+            invPt, cotTheta = pre_estimate(TTStubs_phi, TTStubs_r, TTStubs_z, self.layers[0], self.layers[-1])
+            for itrial in xrange(1 if self.region.pre_estimate else niter):
+                variables1, variables2 = make_variables(self.region, TTStubs_phi, TTStubs_r, TTStubs_z, invPt, cotTheta, dtype=self.dtype)
+                if self.missing_layer is not None:
+                    variables1, variables2 = variables1[:, self.layers], variables2[:, self.layers]
+                parameters_fit, chi2_fit = self.fit_variables(variables1, variables2)
+                invPt, cotTheta = parameters_fit[:,0], parameters_fit[:,2]
+
+            parameters[i:i+block_size] = parameters_fit
+            chi2[i:i+block_size] = chi2_fit
+        return parameters, chi2
+
+def load_fitter(path, **kwargs):
+    arrays, metadata = load_constants(path)
+    return TrackFitter(region_from_dict(metadata["region"]), arrays, missing_layer=metadata.get("missing_layer"), **kwargs)
+
+# ______________________________________________________________________________
+# Fitter with a lookup table of constants binned in the pre-estimated invPt and
+# cotTheta. The bin of every combination is found from its pre-estimate (the
+# pre-estimates outside the table use the closest bin), and its constants are
+# gathered from the (nbins, ...) stacked arrays, so that a batch of
+# combinations in different bins is fitted at once. The variables are
+# corrected with the pre-estimate, as in the training. Every bin has its own
+# offsets b, as in TrackFitter.
+
+lut_names = ["V_var1", "V_var2", "D_var1", "D_var2", "b_var1", "b_var2", "w_var1", "w_var2", "mean_pc1", "mean_pc2"]
+
+class LUTFitter:
+    def __init__(self, region, invPt_edges, cotTheta_edges, constants, dtype=np.float64):
+        self.region = region
+        self.use_3D = region.use_3D
+        self.dtype = dtype
+        self.invPt_edges = np.asarray(invPt_edges)
+        self.cotTheta_edges = np.asarray(cotTheta_edges)
+        self.nbins_invPt = len(self.invPt_edges) - 1
+        self.nbins_cotTheta = len(self.cotTheta_edges) - 1
+
+        if "b_var1" not in constants:
+            raise ValueError("The lookup table has no parameter offsets (b_var1, b_var2), it must be retrained")
+        for name in lut_names:
+            setattr(self, name, np.asarray(constants[name], dtype=dtype))
+        assert(len(self.D_var1) == self.nbins_invPt * self.nbins_cotTheta)
+        self.scale1 = self.normalization(self.w_var1)
+        self.scale2 = self.normalization(self.w_var2)
+
+        self.nchi2_1 = self.V_var1.shape[1] - self.D_var1.shape[1]
+        self.nchi2_2 = self.V_var2.shape[1] - self.D_var2.shape[1]
+        if self.use_3D:
+            self.ndof = self.nchi2_1
+        else:
+            self.ndof = self.nchi2_1 + self.nchi2_2
+
+    def normalization(self, w):
+        w = np.asarray(w)
+        scale = np.zeros(w.shape)
+        scale[np.abs(w) > 1e-14] = 1.0/np.sqrt(w[np.abs(w) > 1e-14])
+        return scale.astype(self.dtype)
+
+    def find_bins(self, invPt, cotTheta):
+        i = np.clip(np.searchsorted(self.invPt_edges, invPt, side="right") - 1, 0, self.nbins_invPt - 1)
+        j = np.clip(np.searchsorted(self.cotTheta_edges, cotTheta, side="right") - 1, 0, self.nbins_cotTheta - 1)
+        return i * self.nbins_cotTheta + j
+
+    def fit_variables(self, variables1, variables2, bins):
+        variables1 = np.asarray(variables1, dtype=self.dtype)
+        variables2 = np.asarray(variables2, dtype=self.dtype)
+        if self.use_3D:
+            variables1 = np.hstack((variables1, variables2))
+
+        if self.use_3D:
+            parameters = np.einsum("nij,nj->ni", self.D_var1[bins], variables1) + self.b_var1[bins]
+        else:
+            parameters = np.hstack((np.einsum("nij,nj->ni", self.D_var1[bins], variables1) + self.b_var1[bins], np.einsum("nij,nj->ni", self.D_var2[bins], variables2) + self.b_var2[bins]))
+
+        # Non-leading principal components
+        npc1 = (np.einsum("nij,nj->ni", self.V_var1[bins, :self.nchi2_1], variables1) - self.mean_pc1[bins, :self.nchi2_1]) * self.scale1[bins, :self.nchi2_1]
+        chi2 = (npc1 * npc1).sum(axis=1)
+        if not self.use_3D:
+            npc2 = (np.einsum("nij,nj->ni", self.V_var2[bins, :self.nchi2_2], variables2) - self.mean_pc2[bins, :self.nchi2_2]) * self.scale2[bins, :self.nchi2_2]
+            chi2 += (npc2 * npc2).sum(axis=1)
+        return parameters, chi2
+
+    def fit(self, phi, z, r, block_size=100000):
+        # Returns the (N, 4) parameters (invPt, phi, cotTheta, z0), the (N,) chi2
+        # and the (N,) bins
+        phi, z, r = np.asarray(phi), np.asarray(z), np.asarray(r)
+        assert(phi.shape == z.shape == r.shape and phi.ndim == 2 and phi.shape[1] == 6)
+
+        n = len(phi)
+        parameters = np.zeros((n, 4), dtype=self.dtype)
+        chi2 = np.zeros(n, dtype=self.dtype)
+        bins = np.zeros(n, dtype=np.int64)
+        for i in xrange(0, n, block_size):
+            TTStubs_phi, TTStubs_z, TTStubs_r = phi[i:i+block_size], z[i:i+block_size], r[i:i+block_size]
+
+            TTStubs_phi, TTStubs_z, TTStubs_r = TTStubs_phi.astype(self.dtype), TTStubs_z.astype(self.dtype), TTStubs_r.astype(self.dtype)
+            invPt, cotTheta = pre_estimate(TTStubs_phi, TTStubs_r, TTStubs_z)
+            bins[i:i+block_size] = self.find_bins(invPt, cotTheta)
+            variables1, variables2 = make_variables(self.region, TTStubs_phi, TTStubs_r, TTStubs_z, invPt, cotTheta, dtype=self.dtype)
+            parameters[i:i+block_size], chi2[i:i+block_size] = self.fit_variables(variables1, variables2, bins[i:i+block_size])
+        return parameters, chi2, bins
+
+def save_lut(path, invPt_edges, cotTheta_edges, constants, metadata, nbits=0):
+    # constants is the list of the constants of every bin, in row-major order.
+    # The bin edges are kept exact in the metadata. In fixed point, the vectors
+    # of every bin (b, w, mean_pc) keep one LSB per element, as in the constants
+    # of one region.
+    arrays = dict((name, np.asarray([c[name] for c in constants])) for name in lut_names)
+    metadata = dict(metadata, invPt_edges=list(invPt_edges), cotTheta_edges=list(cotTheta_edges))
+    per_element = [name for name in lut_names if np.ndim(constants[0][name]) == 1]
+    if nbits:
+        arrays = rounded_offsets(arrays, nbits, nbits)
+    return save_constants(path, arrays, metadata, nbits=nbits, per_element=per_element)
+
+def load_lut_fitter(path, **kwargs):
+    arrays, metadata = load_constants(path)
+    return LUTFitter(region_from_dict(metadata["region"]), metadata["invPt_edges"], metadata["cotTheta_edges"], arrays, **kwargs)
+
+
+# ______________________________________________________________________________
+# Fit the (corrected) variables of known tracks with every precision mode.
+# Returns, for every mode, the fits/s, the bias (mean of fit - truth) and the
+# resolution (rms of fit - truth around the bias) of every parameter, and the
+# resolution relative to the first mode. The bias is kept apart so that a
+# shift of the parameters does not hide the loss of precision. The
+# parameters are given as a list of (N, k) arrays, whose columns are those of
+# the fitted parameters in order, and are fitted in blocks of block_size.
+def default_precision_modes(fixed_point_bits=(18,)):
+    modes = [("float64", {}), ("float32", {"dtype": np.float32})]
+    for nbits in fixed_point_bits:
+        modes.append(("fixed%i" % nbits, {"var_bits": nbits, "d_bits": nbits, "v_bits": nbits}))
+    return modes
+
+def precision_study(region, constants, variables1, variables2, parameters, modes, block_size=100000):
+    n = len(variables1)
+    results = []
+    for name, kwargs in modes:
+        fitter = TrackFitter(region, constants, **kwargs)
+        stat_err = None
+        elapsed = 0.
+        for i in xrange(0, n, block_size):
+            t0 = time.time()
+            fitted = fitter.fit_variables(variables1[i:i+block_size], variables2[i:i+block_size])[0]
+            elapsed += time.time() - t0
+            truth = np.hstack([np.asarray(p[i:i+block_size], dtype=np.float64) for p in parameters])
+            if stat_err is None:
+                stat_err = IncrementalStats(d=truth.shape[1])
+            stat_err.add_batch(fitted - truth)
+        bias, resolution = stat_err.mean(), stat_err.stdev()
+        if not results:
+            reference = resolution
+        results.append((name, n / max(elapsed, 1e-9), bias, resolution, resolution / reference))
+    return results
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    import sys
+
+    if len(sys.argv) < 2:
+        # Self-check: train the default regions on synthetic events, and fit the
+        # stubs of their events with the exported constants. The parameters must
+        # not be biased, i.e. the mean residual must be small against the rms.
+        import os, tempfile
+        from matrixengine import train, default_regions, extract_events, get_branches, region_layers, open_tree, synthetic_fname
+        from matrixconfig import make_options
+
+        print "Usage: %s constants.bin [ncombinations], without arguments a self-check on synthetic events" % sys.argv[0]
+        for geometry in ["barrel", "endcap"]:
+            region = default_regions[geometry]()
+            fname = synthetic_fname(geometry, 50000)
+            options = make_options(fname=fname, nentries=-1, cache_dir="", verbose=0, make_plots=0, missing_layers=0, fixed_point_bits=[], use_3D=region.use_3D, outdir=tempfile.mkdtemp())
+            train([region], options)
+            fitter = load_fitter(os.path.join(options.outdir, "constants.bin"))
+
+            events = extract_events(open_tree(fname).read_columns(get_branches([region]), 0, 50000), region_layers(region))
+            simInvPt = events["simCharge"].astype(np.float64) / events["simPt"]
+            sel = (region.minInvPt <= simInvPt) & (simInvPt < region.maxInvPt) & (region.minEta <= events["simEta"]) & (events["simEta"] < region.maxEta)
+            truth = np.column_stack((simInvPt, events["simPhi"], np.sinh(events["simEta"].astype(np.float64)), events["simVz"]))[sel]
+            parameters, chi2 = fitter.fit(events["TTStubs_phi"][sel], events["TTStubs_z"][sel], events["TTStubs_r"][sel])
+            residuals = parameters - truth
+            print "region : ", region
+            print "bias   : ", residuals.mean(axis=0)
+            print "rms    : ", residuals.std(axis=0)
+            print "chi2   : ", np.median(chi2)
+            assert(np.all(np.abs(residuals.mean(axis=0)) < 0.2 * residuals.std(axis=0)))
+        sys.exit(0)
+
+    fitter = load_fitter(sys.argv[1])
+    region = fitter.region
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    # Straight tracks from the origin, for timing only
+    rng = np.random.RandomState(2016)
+    phi0 = rng.uniform(region.phi_center - 0.3, region.phi_center + 0.3, n)
+    cotTheta = np.sinh(rng.uniform(region.minEta, region.maxEta, n))
+    if region.geometry == "barrel":
+        r = np.tile(region.r_center, (n, 1))
+        z = r * cotTheta[:, np.newaxis]
+    else:
+        z = np.tile(region.z_center, (n, 1))
+        r = z / cotTheta[:, np.newaxis]
+    phi = np.tile(phi0[:, np.newaxis], (1, 6))
+
+    t0 = time.time()
+    parameters, chi2 = fitter.fit(phi, z, r)
+    t1 = time.time()
+    print "region : ", region
+    print "ndof   : ", fitter.ndof
+    print "fits/s : %.3g" % (n / (t1 - t0))
+    print "mean   : ", parameters.mean(axis=0)
+    print "chi2   : ", np.median(chi2)
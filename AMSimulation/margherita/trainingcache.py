@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import pickle
+import shutil
+import numpy as np
+
+# ______________________________________________________________________________
+# On-disk cache of the training data selected in step 1. Every array is stored
+# as a contiguous .npy file so that it can be memory-mapped when reloaded;
+# small python objects (e.g. IncrementalStats) are pickled alongside.
+#
+#   <cache_dir>/<key>/<name>.npy
+#   <cache_dir>/<key>/objects.pkl
+
+def cache_key(*args):
+    h = hashlib.sha1()
+    for x in args:
+        if isinstance(x, np.ndarray):
+            x = x.tolist()
+        h.update(repr(x))
+    return h.hexdigest()
+
+# The input of an entry in the key: a local file is identified by its name,
+# size and modification time, so that a file regenerated under the same name
+# does not reuse the entries of the old one. Other inputs (synthetic, remote)
+# are identified by their name only.
+def input_signature(fname):
+    if os.path.isfile(fname):
+        st = os.stat(fname)
+        return (fname, st.st_size, st.st_mtime)
+    return fname
+
+# The entries are written to a temporary directory first, so that an
+# interrupted job does not leave a partial entry behind. The arrays can also be
+# written there directly by the caller, between begin_ and commit_training_set.
+def begin_training_set(cache_dir, key):
+    tmppath = os.path.join(cache_dir, key) + ".tmp%i" % os.getpid()
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+    return tmppath
+
+def commit_training_set(cache_dir, key, tmppath, objects=None):
+    path = os.path.join(cache_dir, key)
+    with open(os.path.join(tmppath, "objects.pkl"), "wb") as f:
+        pickle.dump(objects, f, pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(path):
+        # Made meanwhile by another job
+        shutil.rmtree(tmppath)
+        return path
+    os.rename(tmppath, path)
+    return path
+
+def save_training_set(cache_dir, key, arrays, objects=None):
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(path):
+        return path
+
+    tmppath = begin_training_set(cache_dir, key)
+    for name, arr in arrays.iteritems():
+        np.save(os.path.join(tmppath, name + ".npy"), np.ascontiguousarray(arr))
+    return commit_training_set(cache_dir, key, tmppath, objects)
+
+def load_training_set(cache_dir, key, mmap_mode="r"):
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    arrays = {}
+    for fname in os.listdir(path):
+        if fname.endswith(".npy"):
+            arrays[fname[:-4]] = np.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+    with open(os.path.join(path, "objects.pkl"), "rb") as f:
+        objects = pickle.load(f)
+    return arrays, objects
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+
+    import tempfile
+
+    cache_dir = tempfile.mkdtemp()
+    key = cache_key("stubs.root", 100000, np.asarray([22.5913, 35.4772]))
+    print key
+
+    data_var1 = np.random.normal(0., 1., (1000, 6))
+    save_training_set(cache_dir, key, {"data_var1": data_var1}, {"count": len(data_var1)})
+    arrays, objects = load_training_set(cache_dir, key)
+    print type(arrays["data_var1"]), objects
+    print np.array_equal(arrays["data_var1"], data_var1)
+    shutil.rmtree(cache_dir)